@@ -0,0 +1,354 @@
+#########################################################################
+# Richie Harris
+# rkharris12@gmail.com
+# 5/23/2021
+#########################################################################
+
+# local bitcoind stand-in for testing fpgaminer.py --solo: getblocktemplate with long polling and submitblock, every block is checked with hashlib
+
+import argparse, base64, hashlib, http.server, json, os, socketserver, struct, sys, threading, time
+
+VERSION = 0x20000000
+# Compact target of the blocks, low enough that a CPU finds some
+BITS = '1e0fffff'
+HEIGHT = 700000
+
+# Made up transactions: random bytes of a fixed size, each paying FEE to the block
+TX_SIZE = 64
+FEE = 1000
+
+# Seconds a long poll waits for a new block or new transactions before returning the same template
+LONGPOLL_TIMEOUT = 60
+
+# Output script validateaddress returns for any address, a P2WPKH
+SCRIPT_PUBKEY = '0014' + '11' * 20
+
+# BIP 141 witness commitment output script header
+WITNESS_COMMITMENT_HEADER = bytes.fromhex('6a24aa21a9ed')
+
+def log(message):
+    print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
+    sys.stdout.flush()
+
+def sha256d(message):
+    '''Double SHA256 Hashing function.'''
+    return hashlib.sha256(hashlib.sha256(message).digest()).digest()
+
+def bits_target(bits):
+    '''The target of a compact (nbits) hex string.'''
+    bits = int(bits, 16)
+    return (bits & 0xffffff) << (8 * ((bits >> 24) - 3))
+
+def merkle_root(hashes):
+    '''Merkle root of hashes rebuilt from scratch, independently of merkle.MerkleTree.'''
+    level = list(hashes)
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        level = [ sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2) ]
+    return level[0]
+
+# BIP 34 height pushes as bitcoind serializes them (CScript() << height), to check height_push against
+HEIGHT_PUSHES = {
+    0: '00',
+    1: '51',
+    16: '60',
+    17: '0111',
+    127: '017f',
+    128: '028000',
+    255: '02ff00',
+    256: '020001',
+    32767: '02ff7f',
+    32768: '03008000',
+    700000: '0360ae0a',
+    8388607: '03ffff7f',
+    8388608: '0400008000'
+}
+
+def height_push(height):
+    '''The push a coinbase scriptSig must start with under BIP 34, written independently of fpgaminer's.
+
+    Heights 1-16 are OP_1..OP_16, others the minimal little endian bytes, with a
+    zero byte added when the top bit is set, as the number would read negative.
+    '''
+    if 1 <= height <= 16: return bytes([ 0x50 + height ])
+    data = [ ]
+    while height:
+        data.append(height & 0xff)
+        height >>= 8
+    if data and data[-1] & 0x80: data.append(0)
+    return bytes([ len(data) ] + data)
+
+class Reader(object):
+    '''Reads the fields of a serialized block.'''
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('block truncated')
+        self.offset += size
+        return self.data[self.offset - size: self.offset]
+
+    def varint(self):
+        n = self.read(1)[0]
+        if n < 0xfd: return n
+        return int.from_bytes(self.read(2 ** (n - 0xfc)), 'little')
+
+    def coinbase(self):
+        '''Returns (txid, script_sig, outputs, witness) of the coinbase transaction at the current offset.'''
+        start = self.offset
+        version = self.read(4)
+        segwit = self.data[self.offset: self.offset + 2] == b'\x00\x01'
+        if segwit: self.read(2)
+        body_start = self.offset
+        if self.varint() != 1:
+            raise ValueError('coinbase must have one input')
+        if self.read(36) != bytes(32) + b'\xff\xff\xff\xff':
+            raise ValueError('coinbase input must be null')
+        script_sig = self.read(self.varint())
+        self.read(4)
+        outputs = [ ]
+        for i in range(self.varint()):
+            value = struct.unpack('<q', self.read(8))[0]
+            outputs.append((value, self.read(self.varint())))
+        body = self.data[body_start: self.offset]
+        witness = [ ]
+        if segwit:
+            witness = [ self.read(self.varint()) for i in range(self.varint()) ]
+        locktime = self.read(4)
+        return (sha256d(version + body + locktime), script_sig, outputs, witness)
+
+class Chain(object):
+    '''The tip the templates build on and the mempool of made up transactions.
+
+    Every accepted block advances the tip and empties the mempool. The long poll
+    id changes with the tip and with every batch of new transactions, waking the
+    getblocktemplate calls waiting on the old one.
+    '''
+
+    def __init__(self, bits = BITS, height = HEIGHT):
+        self._bits = bits
+        self._target = bits_target(bits)
+        self._condition = threading.Condition()
+        self._tip = os.urandom(32)
+        self._height = height
+        self._mempool = [ ]
+        self._updates = 0
+
+        self._start_time = time.time()
+        self._counts = dict(accepted = 0, stale = 0, duplicate = 0, invalid = 0)
+        self._reasons = dict()
+        # Delays from a template being handed out to a block built on it
+        self._template_times = dict()
+        self._latencies = [ ]
+        self._blocks = set()
+
+    target = property(lambda s: s._target)
+
+    def longpollid(self):
+        return '%s%d' % (self._tip[::-1].hex(), self._updates)
+
+    def add_transactions(self, count):
+        with self._condition:
+            self._mempool.extend(os.urandom(TX_SIZE) for i in range(count))
+            self._updates += 1
+            self._condition.notify_all()
+
+    def template(self, longpollid = None):
+        '''The getblocktemplate result, waiting up to LONGPOLL_TIMEOUT for a change if longpollid is current.'''
+        with self._condition:
+            if longpollid is not None:
+                self._condition.wait_for(lambda: longpollid != self.longpollid(), LONGPOLL_TIMEOUT)
+            transactions = [ dict(data = tx.hex(), txid = sha256d(tx)[::-1].hex(), hash = sha256d(tx)[::-1].hex(), fee = FEE, depends = [ ], weight = 4 * TX_SIZE) for tx in self._mempool ]
+            # the fake transactions have no witnesses, so their wtxids are their txids
+            witness_root = merkle_root([ bytes(32) ] + [ sha256d(tx) for tx in self._mempool ])
+            template = dict(
+                version = VERSION,
+                rules = [ 'segwit' ],
+                previousblockhash = self._tip[::-1].hex(),
+                transactions = transactions,
+                coinbasevalue = (5000000000 >> (self._height // 210000)) + FEE * len(transactions),
+                longpollid = self.longpollid(),
+                target = '%064x' % self._target,
+                mintime = int(self._start_time),
+                mutable = [ 'time', 'transactions', 'prevblock' ],
+                noncerange = '00000000ffffffff',
+                curtime = int(time.time()),
+                bits = self._bits,
+                height = self._height,
+                default_witness_commitment = (WITNESS_COMMITMENT_HEADER + sha256d(witness_root + bytes(32))).hex()
+            )
+            self._template_times.setdefault(template['longpollid'], time.time())
+            return template
+
+    def submit(self, block_hex):
+        '''Checks a submitblock; returns None if the block is accepted or the reason it is rejected, like bitcoind.'''
+        received = time.time()
+        try:
+            block = bytes.fromhex(block_hex)
+            reader = Reader(block)
+            header = reader.read(80)
+            count = reader.varint()
+            (coinbase_txid, script_sig, outputs, witness) = reader.coinbase()
+            transactions = [ reader.read(TX_SIZE) for i in range(count - 1) ]
+            if reader.offset != len(block):
+                raise ValueError('trailing data')
+        except ValueError as e:
+            return self._outcome('invalid', 'bad-blk-' + str(e).replace(' ', '-'))
+
+        block_hash = sha256d(header)
+        with self._condition:
+            if block_hash in self._blocks:
+                return self._outcome('duplicate', 'duplicate')
+            if header[4:36] != self._tip:
+                return self._outcome('stale', 'inconclusive-not-best-prevblk')
+            if header[72:76] != bytes.fromhex(self._bits)[::-1]:
+                return self._outcome('invalid', 'bad-diffbits')
+            if int.from_bytes(block_hash, 'little') > self._target:
+                return self._outcome('invalid', 'high-hash')
+
+            mempool = set(self._mempool)
+            if any(tx not in mempool for tx in transactions):
+                return self._outcome('invalid', 'bad-txns-inputs-missingorspent')
+            txids = [ sha256d(tx) for tx in transactions ]
+            if header[36:68] != merkle_root([ coinbase_txid ] + txids):
+                return self._outcome('invalid', 'bad-txnmrklroot')
+            if not script_sig.startswith(height_push(self._height)):
+                return self._outcome('invalid', 'bad-cb-height')
+            if sum(value for (value, script) in outputs) > (5000000000 >> (self._height // 210000)) + FEE * len(transactions):
+                return self._outcome('invalid', 'bad-cb-amount')
+
+            commitments = [ script for (value, script) in outputs if script.startswith(WITNESS_COMMITMENT_HEADER) ]
+            if commitments:
+                if witness != [ bytes(32) ]:
+                    return self._outcome('invalid', 'bad-witness-nonce-size')
+                if commitments[-1][6:38] != sha256d(merkle_root([ bytes(32) ] + txids) + witness[0]):
+                    return self._outcome('invalid', 'bad-witness-merkle-match')
+
+            # the block's template is the oldest one handed out on this tip
+            template_times = [ t for (longpollid, t) in self._template_times.items() if longpollid.startswith(self._tip[::-1].hex()) ]
+            if template_times:
+                self._latencies.append(received - min(template_times))
+
+            self._blocks.add(block_hash)
+            self._tip = block_hash
+            self._height += 1
+            mined = set(transactions)
+            self._mempool = [ tx for tx in self._mempool if tx not in mined ]
+            self._template_times = dict()
+            self._condition.notify_all()
+        log('Block %d accepted: %s (%d transactions)' % (self._height - 1, block_hash[::-1].hex(), count))
+        return self._outcome('accepted', None)
+
+    def _outcome(self, outcome, reason):
+        with self._condition:
+            self._counts[outcome] += 1
+            if reason is not None:
+                self._reasons[reason] = self._reasons.get(reason, 0) + 1
+        return reason
+
+    def report(self):
+        '''Block counts, the reasons blocks were rejected for and the template->block delays so far.'''
+        with self._condition:
+            counts = dict(self._counts)
+            reasons = dict(self._reasons)
+            latencies = sorted(self._latencies)
+            (height, mempool) = (self._height, len(self._mempool))
+        elapsed = time.time() - self._start_time
+        output = 'height=%d mempool=%d accepted=%d stale=%d duplicate=%d invalid=%d (%.2f blocks/s)' % (height, mempool, counts['accepted'], counts['stale'], counts['duplicate'], counts['invalid'], counts['accepted'] / elapsed)
+        if reasons:
+            output += ' reasons: ' + ', '.join('%s=%d' % r for r in sorted(reasons.items()))
+        if latencies:
+            output += ' template->block mean=%.1fms max=%.1fms' % (1000 * sum(latencies) / len(latencies), 1000 * latencies[-1])
+        return output
+
+class RpcHandler(http.server.BaseHTTPRequestHandler):
+    '''bitcoind's JSON-RPC over HTTP; the chain is the server's chain attribute.'''
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.server.authorization and self.headers.get('Authorization') != self.server.authorization:
+            self.send_error(401)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            (method, params) = (request['method'], request.get('params') or [ ])
+        except (ValueError, KeyError):
+            self.send_error(400)
+            return
+
+        chain = self.server.chain
+        (result, error) = (None, None)
+        if method == 'getblocktemplate':
+            request_params = (params + [ { } ])[0]
+            if 'segwit' not in request_params.get('rules', [ ]):
+                error = dict(code = -8, message = 'getblocktemplate must be called with the segwit rule set')
+            else:
+                result = chain.template(request_params.get('longpollid'))
+        elif method == 'submitblock':
+            result = chain.submit(params[0])
+        elif method == 'validateaddress':
+            result = dict(isvalid = True, address = params[0], scriptPubKey = SCRIPT_PUBKEY)
+        else:
+            error = dict(code = -32601, message = 'Method not found')
+
+        body = json.dumps(dict(result = result, error = error, id = request.get('id'))).encode()
+        self.send_response(500 if error else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ThreadingRpcServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Local bitcoind stand-in for testing fpgaminer.py --solo, connect with -o http://127.0.0.1:PORT")
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on')
+    parser.add_argument('--port', type = int, default = 18443, help = 'port to listen on')
+    parser.add_argument('-u', '--user', dest = 'username', default = '', help = 'RPC username, with -p/--pass (default: no authentication)', metavar = "USERNAME")
+    parser.add_argument('-p', '--pass', dest = 'password', default = '', help = 'RPC password', metavar = "PASSWORD")
+    parser.add_argument('--bits', default = BITS, help = 'compact target of the blocks, hex (default %s)' % BITS, metavar = "HEX")
+    parser.add_argument('--height', type = int, default = HEIGHT, help = 'height of the first block', metavar = "N")
+    parser.add_argument('--tx-interval', dest = 'tx_interval', type = float, default = 5, help = 'seconds between batches of new mempool transactions (0 for none)', metavar = "SECONDS")
+    parser.add_argument('--tx-batch', dest = 'tx_batch', type = int, default = 20, help = 'transactions per batch', metavar = "N")
+    parser.add_argument('--report-interval', dest = 'report_interval', type = float, default = 10, help = 'seconds between reports', metavar = "SECONDS")
+    parser.add_argument('--duration', type = float, default = 0, help = 'stop and report after this many seconds (0 runs until interrupted)', metavar = "SECONDS")
+    options = parser.parse_args(sys.argv[1:])
+
+    for (height, push) in sorted(HEIGHT_PUSHES.items()):
+        if height_push(height).hex() != push:
+            raise ValueError('height_push(%d) is %s instead of %s' % (height, height_push(height).hex(), push))
+
+    chain = Chain(options.bits, options.height)
+    server = ThreadingRpcServer((options.host, options.port), RpcHandler)
+    server.chain = chain
+    server.authorization = 'Basic ' + base64.b64encode(('%s:%s' % (options.username, options.password)).encode()).decode() if options.username else None
+
+    def mempool_forever():
+        while True:
+            time.sleep(options.tx_interval)
+            chain.add_transactions(options.tx_batch)
+
+    threads = [ server.serve_forever ] + ([ mempool_forever ] if options.tx_interval > 0 else [ ])
+    for target in threads:
+        thread = threading.Thread(target = target)
+        thread.daemon = True
+        thread.start()
+    log('Listening on %s:%d, bits %s (target %064x)' % (options.host, options.port, options.bits, chain.target))
+
+    end = time.time() + options.duration if options.duration > 0 else None
+    try:
+        while end is None or time.time() < end:
+            time.sleep(max(min(options.report_interval, end - time.time()), 0) if end else options.report_interval)
+            log(chain.report())
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    log('Final: ' + chain.report())
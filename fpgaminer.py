@@ -4,8 +4,10 @@
 # 5/23/2021
 #########################################################################
 
-import base64, json, hashlib, hmac, math, socket, struct, sys, threading, time, urllib.parse, sha256d_fpga_sim
-from pynq import Overlay, mmio
+import asyncio, base64, json, hashlib, hmac, http.client, http.server, math, multiprocessing, os, platform, queue, socket, struct, sys, threading, time, urllib.parse, merkle, sha256d_fpga_sim, hasher_device
+
+# When the miner started, to log how long it took to be ready to mine
+START_TIME = time.time()
 
 # RPC ID
 USER_AGENT = "FPGAMiner"
@@ -14,9 +16,17 @@ VERSION = [0, 1]
 # These control which sha256d implementation to use
 SHA256D_LIBRARY_AUTO    = 'auto'
 SHA256D_LIBRARY_HASHLIB = 'hashlib'
+SHA256D_LIBRARY_MIDSTATE = 'midstate'
 SHA256D_LIBRARY_PYTHON  = 'python'
+SHA256D_LIBRARY_NUMPY   = 'numpy'
 SHA256D_LIBRARY_FPGA    = 'fpga'
-SHA256D_LIBRARIES = [ SHA256D_LIBRARY_AUTO, SHA256D_LIBRARY_HASHLIB, SHA256D_LIBRARY_PYTHON, SHA256D_LIBRARY_FPGA ]
+SHA256D_LIBRARIES = [ SHA256D_LIBRARY_AUTO, SHA256D_LIBRARY_HASHLIB, SHA256D_LIBRARY_MIDSTATE, SHA256D_LIBRARY_PYTHON, SHA256D_LIBRARY_NUMPY, SHA256D_LIBRARY_FPGA ]
+
+# Padding words that follow the 8 word first hash in the block of the second sha256
+SHA256D_SECOND_BLOCK_PAD = (0x80000000, 0, 0, 0, 0, 0, 0, 256)
+
+# Number of nonces hashed per call by the numpy implementation
+NUMPY_BATCH_SIZE = 8192
 
 # Verbosity and log level
 QUIET           = False
@@ -28,46 +38,98 @@ LEVEL_INFO      = 'info'
 LEVEL_DEBUG     = 'debug'
 LEVEL_ERROR     = 'error'
 
-# FPGA hasher register banks
-base_addr = 0x43c00000
-ctl_status_base_addr = 0x000
-mid_state_base_addr = 0x400
-residual_data_base_addr = 0x800
-target_base_addr = 0xc00
-ctl_status_mem = mmio.MMIO(base_addr + ctl_status_base_addr, 24)
-mid_state_mem = mmio.MMIO(base_addr + mid_state_base_addr, 32)
-residual_data_mem = mmio.MMIO(base_addr + residual_data_base_addr, 12)
-target_mem = mmio.MMIO(base_addr + target_base_addr, 32)
+# Bitstream of the hasher overlay, and the file recording which bitstream was last
+# downloaded to the fabric this boot, so a restart can skip reprogramming it
+FPGA_BITSTREAM = '/home/xilinx/overlays/miner_top.bit'
+FPGA_OVERLAY_STATE = '/tmp/fpgaminer_overlay.json'
+
+# Download the bitstream even if the same one is recorded as loaded
+FPGA_FORCE_RELOAD = False
+
+# Driver for the FPGA hasher's registers (see hasher_device.HASHER_DEVICES)
+FPGA_DEVICE_DRIVER = hasher_device.HASHER_DEVICE_PYNQ
+
+# Base addresses of the hashers in the overlay, one device is mined per address
+FPGA_BASE_ADDRS = [ hasher_device.BASE_ADDR ]
+
+# How to wait for the FPGA hasher (see hasher_device.WAIT_STRATEGIES)
+FPGA_WAIT_STRATEGY = hasher_device.WAIT_ADAPTIVE
+
+# Number of FPGA work units prepared ahead of the one hashing (0 prepares them inline)
+FPGA_PREFETCH = 2
+
+# Version bits asked for with mining.configure (BIP 310), the general purpose bits of BIP 320
+VERSION_ROLLING_MASK = 0x1fffe000
+VERSION_ROLLING_MIN_BIT_COUNT = 2
+
+# Bitcoin rejects blocks whose time is more than two hours ahead of the network's
+MAX_NTIME_ROLL = 7200
+
+# Seconds between metrics samples (and their log line), and the localhost port serving them (None to disable)
+METRICS_INTERVAL = 60
+METRICS_PORT = None
+
+def sha256d_midstate(header_prefix_bin):
+    '''Returns the (mid_state, residual_data) integers for a 76 byte header prefix.
+
+    mid_state is the state after hashing the first 512 bit block and residual_data
+    holds the three words of the second block that come before the nonce, both in
+    the word order of the FPGA registers. A whole header (or header template) may
+    be passed too, its nonce is ignored.
+    '''
+    words = struct.unpack_from('>19I', header_prefix_bin)
+    # do the first hash that is independent of the nonce
+    mid_state = sha256d_fpga_sim.compress(sha256d_fpga_sim.STATE_INIT, words[0:16])
+    return (sha256d_fpga_sim.words_to_int(mid_state), sha256d_fpga_sim.words_to_int(words[16:19]))
 
 def sha256d_python(message_bin):
     '''FPGA hashing python simulator.'''
-    message = message_bin.hex() # convert to hex string
-    state_init = 0x5be0cd191f83d9ab9b05688c510e527fa54ff53a3c6ef372bb67ae856a09e667 # initial state of state registers in hash function
-    message_blocks = sha256d_fpga_sim.pad(message)
-    # hash first 512 bit message block
-    first_block = sha256d_fpga_sim.reverse_word_order(message_blocks[0:(512//4)]) # reverse word ordering for hash function
-    data_in = int(first_block, 16) # convert from hex string to numerical data
-    mid_state = sha256d_fpga_sim.hash(state_init, data_in)
-    # hash second 512 bit message_block
-    second_block = sha256d_fpga_sim.reverse_word_order(message_blocks[(512//4):(1024//4)]) # reverse word ordering for hash function
-    data_in = int(second_block, 16) # convert from hex string to numerical data
-    hash_1 = sha256d_fpga_sim.hash(mid_state, data_in)
-    hash_1_word_rev = sha256d_fpga_sim.reverse_word_order(hex(hash_1).rstrip("L").lstrip("0x")) # put it back into big endian word order for padding function
-    # hash a second time
-    padded_in_2 = sha256d_fpga_sim.pad(hash_1_word_rev)
-    block = sha256d_fpga_sim.reverse_word_order(padded_in_2) # reverse word ordering for hash function
-    data_in = int(block, 16) # convert from hex string to numerical data
-    hash_2 = sha256d_fpga_sim.hash(state_init, data_in)
-    hash_2_word_rev = sha256d_fpga_sim.reverse_word_order(hex(hash_2).rstrip("L").lstrip("0x")) # put it back into big endian word order
-    while len(hash_2_word_rev) < 64:
-        hash_2_word_rev = hash_2_word_rev + "0"
-    hash_2_result = bytes.fromhex(hash_2_word_rev) # convert to bytes which is the expected output
-    return hash_2_result
+    padded_bin = sha256d_fpga_sim.pad_bin(message_bin)
+    words = struct.unpack('>%dI' % (len(padded_bin) // 4), padded_bin)
+    state = sha256d_fpga_sim.STATE_INIT
+    for i in range(0, len(words), 16):
+        state = sha256d_fpga_sim.compress(state, words[i:i + 16])
+    # hash a second time, the 256 bit first hash pads to a single block
+    state = sha256d_fpga_sim.compress(sha256d_fpga_sim.STATE_INIT, state + SHA256D_SECOND_BLOCK_PAD)
+    return struct.pack('>8I', *state)
+
+def sha256d_python_midstate(header_view):
+    '''Returns the FPGA hashing python simulator of an 80 byte header template, see sha256d_hashlib_midstate().
+
+    Like the FPGA, the first block is hashed once here and each call only hashes the
+    second block and the second sha256. The rounds and message schedule words of the
+    second block that don't depend on the nonce are computed once too.
+    '''
+    words = struct.unpack_from('>19I', header_view)
+    mid_state = sha256d_fpga_sim.compress(sha256d_fpga_sim.STATE_INIT, words[0:16])
+    precomputed = sha256d_fpga_sim.precompute(mid_state, words[16:19])
+    unpack_nonce = struct.Struct('>I').unpack_from
+    def proof_of_work():
+        state = sha256d_fpga_sim.compress_nonce(precomputed, unpack_nonce(header_view, 76)[0])
+        state = sha256d_fpga_sim.compress(sha256d_fpga_sim.STATE_INIT, state + SHA256D_SECOND_BLOCK_PAD)
+        return struct.pack('>8I', *state)
+    return proof_of_work
 
 def sha256d_hashlib(message):
     '''Double SHA256 Hashing function.'''
     return hashlib.sha256(hashlib.sha256(message).digest()).digest()
 
+def sha256d_hashlib_midstate(header_view):
+    '''Returns a Double SHA256 function of an 80 byte header template, a memoryview of a bytearray.
+
+    The function takes no arguments and hashes the header with whatever nonce was
+    last packed into its final 4 bytes. The first 64 bytes of the header do not
+    depend on the nonce, so they are hashed once here and each call only copies that
+    state and hashes the 16 byte tail, read in place through the memoryview.
+    '''
+    first_block_state = hashlib.sha256(header_view[:64])
+    tail = header_view[64:]
+    def proof_of_work():
+        state = first_block_state.copy()
+        state.update(tail)
+        return hashlib.sha256(state.digest()).digest()
+    return proof_of_work
+
 def log(message, level):
     '''Conditionally write a message to stdout based on command line options and level.'''
     global DEBUG
@@ -94,6 +156,12 @@ def swap_endian_words(hex_words):
     if len(message) % 4 != 0: raise ValueError('Must be 4-byte word aligned')
     return b''.join([ message[4 * i: 4 * i + 4][::-1] for i in range(0, len(message) // 4) ])
 
+def parse_version_mask(hex_mask):
+    '''Converts a version mask from the server, a hexidecimal string of a word, to an int.'''
+    if not isinstance(hex_mask, str) or not 0 < len(hex_mask) <= 8 or hex_mask.strip('0123456789abcdefABCDEF'):
+        raise ValueError('Must be a hexidecimal string of a word')
+    return int(hex_mask, 16)
+
 def human_readable_hashrate(hashrate):
     '''Returns a human readable representation of hashrate.'''
     if hashrate < 1000:
@@ -104,25 +172,204 @@ def human_readable_hashrate(hashrate):
         return '%2f Mhashes/s' % (hashrate / 1000000)
     return '%2f Ghashes/s' % (hashrate / 1000000000)
 
+# Time spent preparing work in this process, stage -> [ seconds, count ], including what
+# WorkerPool processes report; prefetch and mining threads add to it under the lock
+STAGE_TIMES = dict(merkle = [ 0.0, 0 ], midstate = [ 0.0, 0 ])
+STAGE_TIMES_LOCK = threading.Lock()
+
+def record_stage_time(stage, seconds, count = 1):
+    '''Adds timed runs of a work preparation stage to STAGE_TIMES.'''
+    with STAGE_TIMES_LOCK:
+        times = STAGE_TIMES[stage]
+        times[0] += seconds
+        times[1] += count
+
+def stage_times():
+    '''A copy of STAGE_TIMES.'''
+    with STAGE_TIMES_LOCK:
+        return dict((stage, list(times)) for (stage, times) in STAGE_TIMES.items())
+
 SHA256D_LIBRARY = None
 sha256d_proof_of_work = None
+sha256d_numpy = None
+fpga_device = None
+fpga_devices = [ ]
+
+def init_hashlib():
+    return lambda message: sha256d_hashlib(message)
+
+def init_python():
+    return lambda message: sha256d_python(message)
+
+def init_numpy():
+    global sha256d_numpy
+    import sha256d_numpy # numpy is only needed for this implementation
+    # Job.mine() scans nonces with sha256d_numpy.scan(), this only hashes whole messages
+    return lambda message: sha256d_hashlib(message)
+
+def boot_id():
+    '''Identifies the running boot (None if unknown), the fabric loses its bitstream on a power cycle.'''
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def file_sha256(path):
+    '''Hex sha256 of a file's content.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_overlay(bitstream, force = False):
+    '''Downloads the bitstream to the FPGA unless the same bitstream is already loaded.
+
+    Every download records the bitstream's content hash and the boot id in
+    FPGA_OVERLAY_STATE, and while both still match later calls (from new
+    processes too) skip the download. The record can't tell if something else
+    programmed the fabric since, force downloads regardless. Returns (downloaded,
+    seconds taken).
+    '''
+    t0 = time.time()
+    from pynq import Overlay # pynq is only needed on the board
+    state = dict(sha256 = file_sha256(bitstream), boot_id = boot_id())
+    try:
+        with open(FPGA_OVERLAY_STATE) as f:
+            loaded = json.load(f)
+    except (OSError, ValueError):
+        loaded = None
+
+    if not force and state['boot_id'] is not None and loaded == state:
+        return (False, time.time() - t0)
+
+    # forget the old record first, a failed download leaves the fabric unknown
+    if loaded is not None:
+        try:
+            os.remove(FPGA_OVERLAY_STATE)
+        except OSError as e:
+            log('Could not remove the loaded overlay record: %s' % e, LEVEL_ERROR)
+    Overlay(bitstream) # Load Pynq FPGA overlay
+    try:
+        with open(FPGA_OVERLAY_STATE, 'w') as f:
+            json.dump(state, f)
+    except OSError as e:
+        log('Could not record the loaded overlay: %s' % e, LEVEL_ERROR)
+    return (True, time.time() - t0)
+
+def init_fpga():
+    global fpga_device
+    global fpga_devices
+    try:
+        (downloaded, seconds) = load_overlay(FPGA_BITSTREAM, FPGA_FORCE_RELOAD)
+    except OSError as e:
+        # a missing or unreadable bitstream, fail like a missing pynq
+        raise ImportError('could not read the bitstream %s: %s' % (FPGA_BITSTREAM, e))
+    if downloaded:
+        log('Loaded overlay %s in %.3fs' % (FPGA_BITSTREAM, seconds), LEVEL_INFO)
+    else:
+        log('Overlay %s is already loaded, skipped the download (%.3fs)' % (FPGA_BITSTREAM, seconds), LEVEL_INFO)
+    fpga_devices = [ hasher_device.open_device(FPGA_DEVICE_DRIVER, base_addr) for base_addr in FPGA_BASE_ADDRS ]
+    fpga_device = fpga_devices[0]
+    return None
+
+# The sha256d implementations: each function imports and sets up what its
+# implementation needs and returns the proof of work function (None for the FPGA),
+# it only runs when set_sha256d_library() first selects the implementation
+SHA256D_BACKENDS = {
+    SHA256D_LIBRARY_HASHLIB: init_hashlib,
+    SHA256D_LIBRARY_MIDSTATE: init_hashlib,
+    SHA256D_LIBRARY_PYTHON: init_python,
+    SHA256D_LIBRARY_NUMPY: init_numpy,
+    SHA256D_LIBRARY_FPGA: init_fpga
+}
+
+# Initialized implementations, name -> (proof of work function, seconds the initialization took)
+sha256d_backends = dict()
+
+def sha256d_init_time(library = None):
+    '''Seconds the implementation (by default the selected one) took to initialize.'''
+    return sha256d_backends[library or SHA256D_LIBRARY][1]
+
 def set_sha256d_library(library = SHA256D_LIBRARY_AUTO):
-    '''Sets the sha256d library implementation to use.'''
+    '''Sets the sha256d library implementation to use, initializing it the first time it is selected.'''
     global SHA256D_LIBRARY
     global sha256d_proof_of_work
 
-    if library == SHA256D_LIBRARY_FPGA:
-        overlay = Overlay('/home/xilinx/overlays/miner_top.bit') # Load Pynq FPGA overlay
-        sha256d_proof_of_work = None
-        SHA256D_LIBRARY = library
+    if library not in SHA256D_BACKENDS:
+        library = SHA256D_LIBRARY_HASHLIB
 
-    elif library == SHA256D_LIBRARY_PYTHON:
-        sha256d_proof_of_work = lambda message: sha256d_python(message)
-        SHA256D_LIBRARY = library
-  
-    else:
-        sha256d_proof_of_work = lambda message: sha256d_hashlib(message)
-        SHA256D_LIBRARY = SHA256D_LIBRARY_HASHLIB
+    if library not in sha256d_backends:
+        t0 = time.time()
+        proof_of_work = SHA256D_BACKENDS[library]()
+        sha256d_backends[library] = (proof_of_work, time.time() - t0)
+        log('Initialized sha256d library %r in %.1fms' % (library, 1000 * sha256d_backends[library][1]), LEVEL_DEBUG)
+
+    sha256d_proof_of_work = sha256d_backends[library][0]
+    SHA256D_LIBRARY = library
+
+class WorkPrefetcher(object):
+    '''Iterates over work units that a background thread prepares ahead of time.
+
+    The thread keeps up to depth work units from the work_units iterator queued,
+    so the next one is ready as soon as the consumer asks for it. close() stops
+    the thread and drops anything still queued, ending the iteration even for a
+    consumer already waiting on the queue. An exception raised preparing work is
+    raised again by the consumer's next().
+    '''
+
+    def __init__(self, work_units, depth):
+        self._work_units = work_units
+        self._queue = queue.Queue(depth)
+        self._closed = False
+        self._error = None
+
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        '''Queues an item, returns False if closed first.'''
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for work in self._work_units:
+                if not self._put(work): return
+        except Exception as e:
+            self._error = e
+        finally:
+            # the end of the work units, or the error, wakes the consumer
+            self._put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._closed:
+            try:
+                work = self._queue.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            if work is not None: return work
+            if self._error is not None: raise self._error
+            break
+        raise StopIteration()
+
+    def close(self):
+        '''Stops preparing work and drops the queued work units.'''
+        self._closed = True
+        try:
+            while True: self._queue.get_nowait()
+        except queue.Empty:
+            pass
 
 class Job(object):
     '''Encapsulates a Job from the network and necessary helper methods to mine.
@@ -130,7 +377,7 @@ class Job(object):
         "If you have a procedure with 10 parameters, you probably missed some."
            ~Alan Perlis
     '''
-    def __init__(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, target, extranonce1, extranonce2_size, proof_of_work):
+    def __init__(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, target, extranonce1, extranonce2_size, proof_of_work, received = None, version_mask = 0, ntime_roll = 0):
         # Job parts from the mining.notify command
         self._job_id = job_id
         self._prevhash = prevhash
@@ -144,10 +391,35 @@ class Job(object):
         self._target = target
         self._extranonce1 = extranonce1
         self._extranonce2_size = extranonce2_size
+        # Version bits the pool lets us roll (mining.configure), 0 if none
+        self._version_mask = version_mask
+        # Seconds the header's ntime may be rolled past the job's ntime
+        self._ntime_roll = ntime_roll
+        # Binary job parts, decoded once instead of on every extranonce2
+        self._coinb1_bin = bytes.fromhex(coinb1)
+        self._coinb2_bin = bytes.fromhex(coinb2)
+        self._extranonce1_bin = bytes.fromhex(extranonce1)
+        self._merkle_branches_bin = tuple(bytes.fromhex(b) for b in merkle_branches)
+        self._version_bin = swap_endian_word(version)
+        self._prevhash_bin = swap_endian_words(prevhash)
+        self._ntime_bin = swap_endian_word(ntime)
+        self._nbits_bin = swap_endian_word(nbits)
+        if len(self._prevhash_bin) != 32 or set(map(len, (self._version_bin, self._ntime_bin, self._nbits_bin))) != { 4 }:
+            raise ValueError('prevhash must be 32 bytes and version, nbits and ntime 4 bytes')
+        # Integer target, so mining compares numbers instead of hex strings
+        self._target_int = None if target is None else int(target, 16)
         # Proof of work algorithm
         self._proof_of_work = proof_of_work
-        # Flag to stop this job's mine coroutine
+        # Flag to stop this job's mine coroutine, and whether its shares are stale once stopped
         self._done = False
+        self._stale = False
+        # Set with _done, wakes a thread waiting on the FPGA
+        self._stopped = threading.Event()
+        # Time the mining.notify arrived, and how long after it hashing began
+        self._received = received
+        self._start_latency = None
+        # Background preparation of FPGA work units, dropped when the job stops
+        self._prefetcher = None
         # Hash metrics (start time, delta time, total hashes)
         self._dt = 0.0
         self._hash_count = 0
@@ -165,9 +437,16 @@ class Job(object):
     target = property(lambda s: s._target)
     extranonce1 = property(lambda s: s._extranonce1)
     extranonce2_size = property(lambda s: s._extranonce2_size)
+    version_mask = property(lambda s: s._version_mask)
+    ntime_roll = property(lambda s: s._ntime_roll)
 
     proof_of_work = property(lambda s: s._proof_of_work)
 
+    received = property(lambda s: s._received)
+    start_latency = property(lambda s: s._start_latency)
+    stale = property(lambda s: s._stale)
+    hash_count = property(lambda s: s._hash_count)
+
     @property
     def hashrate(self):
         '''The current hashrate, or if stopped hashrate for the job's lifetime.'''
@@ -176,19 +455,128 @@ class Job(object):
 
     def merkle_root_bin(self, extranonce2_bin):
         '''Builds a merkle root from the merkle tree'''
-        coinbase_bin = bytes.fromhex(self._coinb1) + bytes.fromhex(self._extranonce1) + extranonce2_bin + bytes.fromhex(self._coinb2)
+        coinbase_bin = self._coinb1_bin + self._extranonce1_bin + extranonce2_bin + self._coinb2_bin
         coinbase_hash_bin = sha256d_hashlib(coinbase_bin)
 
         merkle_root = coinbase_hash_bin
-        for branch in self._merkle_branches:
-            merkle_root = sha256d_hashlib(merkle_root + bytes.fromhex(branch))
+        for branch_bin in self._merkle_branches_bin:
+            merkle_root = sha256d_hashlib(merkle_root + branch_bin)
         return merkle_root
 
-    def stop(self):
-        '''Requests the mine coroutine stop after its current iteration.'''
+    def header_prefix_bin(self, extranonce2_bin):
+        '''Builds the first 76 bytes of the block header, everything but the nonce.'''
+        return self._version_bin + self._prevhash_bin + self.merkle_root_bin(extranonce2_bin) + self._ntime_bin + self._nbits_bin
+
+    def params(self):
+        '''The arguments this job was created with, except proof_of_work.'''
+        return dict(
+            job_id = self.id,
+            prevhash = self.prevhash,
+            coinb1 = self.coinb1,
+            coinb2 = self.coinb2,
+            merkle_branches = self.merkle_branches,
+            version = self.version,
+            nbits = self.nbits,
+            ntime = self.ntime,
+            target = self.target,
+            extranonce1 = self.extranonce1,
+            extranonce2_size = self.extranonce2_size,
+            received = self.received,
+            version_mask = self.version_mask,
+            ntime_roll = self.ntime_roll
+        )
+
+    def copy(self):
+        '''Returns a new Job for the same work with its own mining state, for mining on another device.'''
+        return Job(proof_of_work = self._proof_of_work, **self.params())
+
+    def version_rolls(self):
+        '''Yields every value of the version bits under the version mask, starting with none set.'''
+        mask = self._version_mask
+        version_bits = 0
+        while True:
+            yield version_bits
+            # next subset of the mask's bits
+            version_bits = (version_bits - mask) & mask
+            if version_bits == 0: return
+
+    def ntime_rolls(self):
+        '''Returns the (ntime, ntime_bin) of every header time to mine, the job's own first.'''
+        ntime = int(self._ntime, 16)
+        return [ (self._ntime, self._ntime_bin) ] + [ ('%08x' % (ntime + i), struct.pack('<I', ntime + i)) for i in range(1, self._ntime_roll + 1) ]
+
+    def work_units(self, extranonce2_start = 0, extranonce2_stride = 1):
+        '''Yields the work for each nonce range of this job as a dict.
+
+        Each work unit has the extranonce2 (as bytes), the version bits rolled into
+        the header, the ntime (as the hex string to submit) and the 76 byte header
+        prefix. extranonce2_start and extranonce2_stride partition the extranonce2
+        space between devices mining the same job. Every merkle root is reused for
+        a nonce range per value of the version bits and per rolled ntime; the ntime
+        is rolled innermost since it is in the header's second block and leaves the
+        midstate unchanged.
+        '''
+        version = struct.unpack('<I', self._version_bin)[0] & ~self._version_mask
+        ntimes = self.ntime_rolls()
+
+        # @TODO: test for extranonce != 0... Do I reverse it or not?
+        for extranonce2 in range(extranonce2_start, 0x7fffffff, extranonce2_stride):
+
+            # Must be unique for any given job id, according to http://mining.bitcoin.cz/stratum-mining/ but never seems enforced?
+            extranonce2_bin = struct.pack('<I', extranonce2)
+
+            t0 = time.time()
+            merkle_root_bin = self.merkle_root_bin(extranonce2_bin)
+            record_stage_time('merkle', time.time() - t0)
+
+            for version_bits in self.version_rolls():
+                header_head_bin = struct.pack('<I', version | version_bits) + self._prevhash_bin + merkle_root_bin
+                for (ntime, ntime_bin) in ntimes:
+                    yield dict(extranonce2_bin = extranonce2_bin, version_bits = version_bits, ntime = ntime, header_prefix_bin = header_head_bin + ntime_bin + self._nbits_bin)
+
+    def fpga_work_units(self, extranonce2_start = 0, extranonce2_stride = 1):
+        '''Yields the work units with the mid_state and residual_data for the FPGA registers added.
+
+        Work units that only roll the ntime share the first 64 bytes of the header,
+        so their mid_state is computed once and only residual_data changes.
+        '''
+        first_block_bin = None
+        for work in self.work_units(extranonce2_start, extranonce2_stride):
+            header_prefix_bin = work['header_prefix_bin']
+            if header_prefix_bin[:64] != first_block_bin:
+                t0 = time.time()
+                (mid_state, residual_data) = sha256d_midstate(header_prefix_bin)
+                record_stage_time('midstate', time.time() - t0)
+                first_block_bin = header_prefix_bin[:64]
+            else:
+                residual_data = sha256d_fpga_sim.words_to_int(struct.unpack('>3I', header_prefix_bin[64:]))
+            (work['mid_state'], work['residual_data']) = (mid_state, residual_data)
+            yield work
+
+    def share(self, work, nonce):
+        '''The result for a share found at nonce in a work unit, as mining.submit wants it.'''
+        result = dict(
+            job_id = self.id,
+            extranonce2 = work['extranonce2_bin'].hex(),
+            ntime = str(work['ntime']), # Convert to str from json unicode
+            nonce = '%08x' % nonce
+        )
+        if self._version_mask:
+            result['version_bits'] = '%08x' % work['version_bits']
+        return result
+
+    def stop(self, stale = True):
+        '''Requests the mine coroutine stop after its current iteration.
+
+        stale is False when the pool still accepts this job's shares (a mining.notify
+        without clean_jobs), so a share yielded while stopping may still be submitted.
+        '''
+        self._stale = stale
         self._done = True
+        self._stopped.set()
+        if self._prefetcher: self._prefetcher.close()
 
-    def mine(self, nonce_start = 0, nonce_stride = 1):
+    def mine(self, nonce_start = 0, nonce_stride = 1, extranonce2_start = 0, extranonce2_stride = 1, device = None):
         '''Returns an iterator that iterates over valid proof-of-work shares.
 
         This is a co-routine; that takes a LONG time; the calling thread should look like:
@@ -199,99 +587,135 @@ class Job(object):
        nonce_start and nonce_stride are useful for multi-processing if you would like
        to assign each process a different starting nonce (0, 1, 2, ...) and a stride
        equal to the number of processes.
+
+       extranonce2_start and extranonce2_stride do the same with whole nonce ranges,
+       for devices that always scan every nonce like the FPGA. device is the
+       HasherDevice to mine on, the default FPGA hasher if it is not given and the
+       fpga implementation is selected.
         '''
+        if device is None and SHA256D_LIBRARY == SHA256D_LIBRARY_FPGA:
+            device = fpga_device
+
         t0 = time.time()
 
-        # @TODO: test for extranonce != 0... Do I reverse it or not?
-        for extranonce2 in range(0, 0x7fffffff):
+        # Target for the CPU loop's early reject on the most significant byte, then word, of the hash
+        target = self._target_int
+        target_byte = target >> 248
+        target_word = target >> 224
+        unpack_top_word = struct.Struct('<I').unpack_from
+
+        # Header template of the CPU loop: each work unit's prefix is copied into it and
+        # each nonce packed into its last 4 bytes in place, so no bytes are built per nonce.
+        # The midstate functions read it through one memoryview made here, not per work unit
+        header_bin = bytearray(80)
+        header_view = memoryview(header_bin)
+        pack_nonce = struct.Struct('<I').pack_into
+
+        if device is not None:
+            work_units = self.fpga_work_units(extranonce2_start, extranonce2_stride)
+            # prepare the next work units while the FPGA hashes the current one
+            if FPGA_PREFETCH > 0:
+                work_units = self._prefetcher = WorkPrefetcher(work_units, FPGA_PREFETCH)
+        else:
+            work_units = self.work_units(extranonce2_start, extranonce2_stride)
 
-            # Must be unique for any given job id, according to http://mining.bitcoin.cz/stratum-mining/ but never seems enforced?
-            extranonce2_bin = struct.pack('<I', extranonce2)
+        try:
+            for work in work_units:
+                header_prefix_bin = work['header_prefix_bin']
 
-            merkle_root_bin = self.merkle_root_bin(extranonce2_bin)
-            header_prefix_bin = swap_endian_word(self._version) + swap_endian_words(self._prevhash) + merkle_root_bin + swap_endian_word(self._ntime) + swap_endian_word(self._nbits)
-
-            if SHA256D_LIBRARY == SHA256D_LIBRARY_FPGA:
-                header_prefix = header_prefix_bin.hex() # convert to hex string
-                # do the first hash that is independent of the nonce
-                state_init = 0x5be0cd191f83d9ab9b05688c510e527fa54ff53a3c6ef372bb67ae856a09e667 # initial state of state registers in hash function
-                first_block = sha256d_fpga_sim.reverse_word_order(header_prefix[0:(512//4)])
-                data_in = int(first_block, 16)
-                mid_state = sha256d_fpga_sim.hash(state_init, data_in)
-                residual_data = int(sha256d_fpga_sim.reverse_word_order(header_prefix[-24:]), 16)
-                target = int(self.target, 16) # convert target to int
-            
-                # write the FPGA registers to configure and start the hasher
-                for offset in list(range(8)): # set mid_state
-                    mid_state_mem.write(4*offset, sha256d_fpga_sim.idx(mid_state, offset))
-                for offset in list(range(3)): # set residual_data
-                    residual_data_mem.write(4*offset, sha256d_fpga_sim.idx(residual_data, offset))
-                for offset in list(range(8)): # set target
-                    target_mem.write(4*offset, sha256d_fpga_sim.idx(target, offset))
-                ctl_status_mem.write(0x4, 0x1) # start the hasher
-                # wait for hasher to find the nonce or request new data to hash
-                fpga_result = "none"
-                while (True):
-                    # This job has been asked to stop
-                    if self._done:
-                        ctl_status_mem.write(0x10, 0x1)
-                        num_hashes = ctl_status_mem.read(0x14)
-                        ctl_status_mem.write(0x0, 0x1)
-                        self._hash_count += num_hashes
-                        self._dt += (time.time() - t0)
-                        raise StopIteration()
-                    status = ctl_status_mem.read(0x8)
-                    if (status == 1):
-                        fpga_result = ctl_status_mem.read(0xc)
-                        break
-                    elif (status == 2):
-                        break
-
-                # if nonce was found, submit result
-                if fpga_result != "none":
-                    nonce_bin = struct.pack('<I', fpga_result)
-
-                    result = dict(
-                        job_id = self.id,
-                        extranonce2 = extranonce2_bin.hex(),
-                        ntime = str(self._ntime), # Convert to str from json unicode
-                        nonce = nonce_bin[::-1].hex()
-                    )
-                    self._dt += (time.time() - t0)
-                    self._hash_count += fpga_result
-
-                    yield result
-
-                    t0 = time.time()
-                else:
-                    self._hash_count += 2**32
-            else:
-                for nonce in range(nonce_start, 0xffffffff, nonce_stride):
-                    # This job has been asked to stop
-                    if self._done:
-                        self._dt += (time.time() - t0)
-                        raise StopIteration()
+                if self._start_latency is None and self._received is not None:
+                    self._start_latency = time.time() - self._received
 
-                    # Proof-of-work attempt
-                    nonce_bin = struct.pack('<I', nonce)
+                if device is not None:
+                    (mid_state, residual_data) = (work['mid_state'], work['residual_data'])
 
-                    pow = self.proof_of_work(header_prefix_bin + nonce_bin)[::-1].hex()
+                    # write the FPGA registers to configure and start the hasher
+                    device.program(mid_state, residual_data, target)
+                    device.start()
+                    # wait for hasher to find the nonce or request new data to hash
+                    fpga_result = "none"
+                    status = device.wait(FPGA_WAIT_STRATEGY, lambda: self._done, self._stopped)
+                    # This job has been asked to stop
+                    if status is None:
+                        self._hash_count += device.stop()
+                        self._dt += (time.time() - t0)
+                        return
+                    if (status == hasher_device.STATUS_FOUND):
+                        fpga_result = device.golden_nonce()
 
-                    # Did we reach or exceed our target?
-                    if pow <= self.target:
-                        result = dict(
-                            job_id = self.id,
-                            extranonce2 = extranonce2_bin.hex(),
-                            ntime = str(self._ntime), # Convert to str from json unicode
-                            nonce = nonce_bin[::-1].hex()
-                        )
+                    # if nonce was found, submit result
+                    if fpga_result != "none":
+                        result = self.share(work, fpga_result)
                         self._dt += (time.time() - t0)
+                        self._hash_count += fpga_result
 
                         yield result
 
                         t0 = time.time()
-
-                    self._hash_count += 1
+                    else:
+                        self._hash_count += 2**32
+                elif SHA256D_LIBRARY == SHA256D_LIBRARY_NUMPY:
+                    t1 = time.time()
+                    (mid_state, residual_data) = sha256d_midstate(header_prefix_bin)
+                    precomputed = sha256d_numpy.precompute(mid_state, residual_data)
+                    record_stage_time('midstate', time.time() - t1)
+
+                    for batch_start in range(nonce_start, 0xffffffff, NUMPY_BATCH_SIZE * nonce_stride):
+                        # This job has been asked to stop
+                        if self._done:
+                            self._dt += (time.time() - t0)
+                            return
+
+                        batch_size = min(NUMPY_BATCH_SIZE, (0xffffffff - batch_start + nonce_stride - 1) // nonce_stride)
+                        found = sha256d_numpy.scan(mid_state, residual_data, batch_start, batch_size, target, nonce_stride, precomputed)
+                        self._hash_count += batch_size
+
+                        for index in found.nonzero()[0]:
+                            result = self.share(work, batch_start + int(index) * nonce_stride)
+                            self._dt += (time.time() - t0)
+
+                            yield result
+
+                            t0 = time.time()
+                else:
+                    header_view[:76] = header_prefix_bin
+                    t1 = time.time()
+                    if SHA256D_LIBRARY == SHA256D_LIBRARY_MIDSTATE:
+                        proof_of_work = sha256d_hashlib_midstate(header_view)
+                    elif SHA256D_LIBRARY == SHA256D_LIBRARY_PYTHON:
+                        proof_of_work = sha256d_python_midstate(header_view)
+                    else:
+                        pow_fn = self.proof_of_work
+                        proof_of_work = lambda: pow_fn(header_bin)
+                    if SHA256D_LIBRARY in (SHA256D_LIBRARY_MIDSTATE, SHA256D_LIBRARY_PYTHON):
+                        record_stage_time('midstate', time.time() - t1)
+
+                    for nonce in range(nonce_start, 0xffffffff, nonce_stride):
+                        # This job has been asked to stop
+                        if self._done:
+                            self._dt += (time.time() - t0)
+                            return
+
+                        # Proof-of-work attempt
+                        pack_nonce(header_bin, 76, nonce)
+
+                        pow = proof_of_work()
+
+                        # Did we reach or exceed our target? The hash is a little endian number, so its
+                        # top byte (an int without allocating) and then top word reject almost every
+                        # nonce before the full 256 bit compare
+                        if pow[31] <= target_byte and unpack_top_word(pow, 28)[0] <= target_word and int.from_bytes(pow, 'little') <= target:
+                            result = self.share(work, nonce)
+                            self._dt += (time.time() - t0)
+
+                            yield result
+
+                            t0 = time.time()
+
+                        self._hash_count += 1
+        finally:
+            # also drops the prepared work when the caller abandons this generator
+            if self._prefetcher: self._prefetcher.close()
 
     def __str__(self):
         return '<Job id=%s prevhash=%s coinb1=%s coinb2=%s merkle_branches=%s version=%s nbits=%s ntime=%s target=%s extranonce1=%s extranonce2_size=%d>' % (self.id, self.prevhash, self.coinb1, self.coinb2, self.merkle_branches, self.version, self.nbits, self.ntime, self.target, self.extranonce1, self.extranonce2_size)
@@ -314,6 +738,8 @@ class Subscription(object):
         self._target = None
         self._worker_name = None
         self._mining_thread = None
+        self._version_mask = 0
+        self._ntime_roll = 0
 
     # Accessors
     id = property(lambda s: s._id)
@@ -325,6 +751,9 @@ class Subscription(object):
     extranonce1 = property(lambda s: s._extranonce1)
     extranonce2_size = property(lambda s: s._extranonce2_size)
 
+    version_mask = property(lambda s: s._version_mask)
+    ntime_roll = property(lambda s: s._ntime_roll)
+
     def set_worker_name(self, worker_name):
         if self._worker_name:
             raise self.StateException('Already authenticated as %r (requesting %r)' % (self._username, username))
@@ -334,6 +763,13 @@ class Subscription(object):
     def _set_target(self, target):
         self._target = '%064x' % target
 
+    def set_target(self, target):
+        '''Sets the share target directly, as solo mining uses the block's target.'''
+        if not 0 <= target < 2 ** 256: raise self.StateException('Target must be 256 bits')
+
+        self._difficulty = (0xffff0000 * 2 ** (256 - 64) + 1) / (target + 1)
+        self._set_target(target)
+
     def set_difficulty(self, difficulty):
         if difficulty < 0: raise self.StateException('Difficulty must be non-negative')
 
@@ -346,6 +782,20 @@ class Subscription(object):
         self._difficulty = difficulty
         self._set_target(target)
 
+    def set_version_mask(self, version_mask):
+        '''Sets the version bits new jobs may roll, 0 to mine the pool's version as is.'''
+        if version_mask & ~0xffffffff or version_mask < 0:
+            raise self.StateException('Version mask must be 32 bits')
+
+        self._version_mask = version_mask
+
+    def set_ntime_roll(self, ntime_roll):
+        '''Sets how many seconds new jobs may roll the ntime forward, 0 to mine the pool's ntime only.'''
+        if not 0 <= ntime_roll <= MAX_NTIME_ROLL:
+            raise self.StateException('Ntime roll must be between 0 and %d seconds' % MAX_NTIME_ROLL)
+
+        self._ntime_roll = ntime_roll
+
     def set_subscription(self, subscription_id, extranonce1, extranonce2_size):
         if self._id is not None:
             raise self.StateException('Already subscribed')
@@ -354,7 +804,7 @@ class Subscription(object):
         self._extranonce1 = extranonce1
         self._extranonce2_size = extranonce2_size
 
-    def create_job(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime):
+    def create_job(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, received = None):
         '''Creates a new Job object populated with all the goodness it needs to mine.'''
         if self._id is None:
             raise self.StateException('Not subscribed')
@@ -371,7 +821,10 @@ class Subscription(object):
             target = self.target,
             extranonce1 = self._extranonce1,
             extranonce2_size = self.extranonce2_size,
-            proof_of_work = self.ProofOfWork
+            proof_of_work = self.ProofOfWork,
+            received = received,
+            version_mask = self._version_mask,
+            ntime_roll = self._ntime_roll
         )
 
     def __str__(self):
@@ -381,6 +834,388 @@ class SubscriptionSHA256D(Subscription):
     '''Subscription for Double-SHA256-based coins, like Bitcoin.'''
     ProofOfWork = lambda s, m: (sha256d_proof_of_work(m))
 
+class JobSwap(object):
+    '''Hands the newest job to a long running mining loop.
+
+    put() stops the job being mined and replaces any job that has not been taken
+    yet; clean says whether the stopped job's shares are stale. take() blocks until
+    there is a new job and returns it with its mining arguments, or None once
+    shutdown() has been called.
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._current = None
+        self._pending = None
+        self._shutdown = False
+
+    def put(self, job, *args, clean = True):
+        with self._condition:
+            if self._current: self._current.stop(stale = clean)
+            self._pending = (job, args)
+            self._condition.notify()
+
+    def shutdown(self):
+        with self._condition:
+            if self._current: self._current.stop()
+            self._shutdown = True
+            self._pending = None
+            self._condition.notify()
+
+    def take(self):
+        with self._condition:
+            while self._pending is None and not self._shutdown:
+                self._condition.wait()
+            if self._shutdown: return None
+            (self._current, args) = self._pending
+            self._pending = None
+            return (self._current, args)
+
+def _pool_worker(index, workers, library, options, job_queue, result_queue):
+    '''Mining process body for WorkerPool; scans every workers-th nonce starting at index.'''
+    global QUIET
+    global DEBUG
+    global DEBUG_PROTOCOL
+    global NUMPY_BATCH_SIZE
+
+    global STAGE_TIMES
+    global STAGE_TIMES_LOCK
+
+    (QUIET, DEBUG, DEBUG_PROTOCOL, NUMPY_BATCH_SIZE) = options
+    set_sha256d_library(library)
+
+    # Stage times are reported to the parent as this process's totals, so start from none
+    STAGE_TIMES = dict((stage, [ 0.0, 0 ]) for stage in STAGE_TIMES)
+    STAGE_TIMES_LOCK = threading.Lock()
+
+    # A listener thread swaps in new jobs so the mining loop never blocks on the queue
+    swap = JobSwap()
+
+    def listen():
+        while True:
+            message = job_queue.get()
+            if message is None:
+                swap.shutdown()
+                return
+            (params, extranonce2_start, extranonce2_stride, clean_jobs) = message
+            swap.put(Job(proof_of_work = lambda message: sha256d_proof_of_work(message), **params), extranonce2_start, extranonce2_stride, clean = clean_jobs)
+
+    listener = threading.Thread(target = listen)
+    listener.daemon = True
+    listener.start()
+
+    # Hashes done on finished jobs and the job being mined, reported every second for the
+    # metrics along with the stage times
+    progress = [ 0, None ]
+
+    def report():
+        while True:
+            time.sleep(1)
+            (hash_total, job) = progress
+            result_queue.put(('hashes', index, hash_total + (job.hash_count if job else 0), stage_times()))
+
+    reporter = threading.Thread(target = report)
+    reporter.daemon = True
+    reporter.start()
+
+    while True:
+        taken = swap.take()
+        if taken is None: return
+        (job, (extranonce2_start, extranonce2_stride)) = taken
+        progress[:] = [ progress[0], job ]
+
+        try:
+            for result in job.mine(nonce_start = index, nonce_stride = workers, extranonce2_start = extranonce2_start, extranonce2_stride = extranonce2_stride):
+                if not job.stale: result_queue.put(('share', index, result))
+        except Exception as e:
+            log("ERROR: worker %d: %s" % (index, e), LEVEL_ERROR)
+        progress[:] = [ progress[0] + job.hash_count, None ]
+        result_queue.put(('hashrate', index, job.id, job.hashrate, job.start_latency))
+
+def log_hashrate(name, job_id, hashrate, start_latency = None):
+    '''Default hashrate report for devices that are not part of a DeviceScheduler.'''
+    log("Hashrate: %s" % human_readable_hashrate(hashrate), LEVEL_INFO)
+
+class WorkerPool(object):
+    '''Pool of mining processes that share the current job.
+
+    Worker i scans nonces i, i + N, i + 2N, ... of every extranonce2 using the
+    nonce_start and nonce_stride arguments of Job.mine(), so N workers cover one
+    nonce range together. Jobs are sent to each worker over its own queue and the
+    workers replace their current job as soon as a new one arrives; the processes
+    live for the lifetime of the pool. Found shares come back over a single result
+    queue and are passed to on_share from a collector thread, and the pool's total
+    hashrate goes to on_hashrate(name, job_id, hashrate) once every worker has left
+    a job, with the slowest worker's delay from the mining.notify to its first hash.
+    '''
+
+    def __init__(self, workers, library, on_share, on_hashrate = log_hashrate, name = 'cpu'):
+        self._workers = workers
+        self._name = name
+        self._on_share = on_share
+        self._on_hashrate = on_hashrate
+        self._result_queue = multiprocessing.Queue()
+        self._job_queues = [ multiprocessing.Queue() for i in range(workers) ]
+        self._hashrates = dict()
+        # The two newest job ids, see DeviceScheduler
+        self._lock = threading.Lock()
+        self._job_ids = [ ]
+        self._worker_hashes = [ 0 ] * workers
+        # Each worker's last reported stage times, the parent's STAGE_TIMES gets the difference
+        self._worker_stage_times = [ dict() for i in range(workers) ]
+
+        options = (QUIET, DEBUG, DEBUG_PROTOCOL, NUMPY_BATCH_SIZE)
+        self._processes = [ ]
+        for (index, job_queue) in enumerate(self._job_queues):
+            process = multiprocessing.Process(target = _pool_worker, args = (index, workers, library, options, job_queue, self._result_queue))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        self._collector_thread = threading.Thread(target = self._collect)
+        self._collector_thread.daemon = True
+        self._collector_thread.start()
+
+    name = property(lambda s: s._name)
+    workers = property(lambda s: s._workers)
+
+    def hashes(self):
+        '''Total hashes done by the workers, as of their last report (about once a second).'''
+        return sum(self._worker_hashes)
+
+    def set_job(self, job, extranonce2_start = 0, extranonce2_stride = 1, clean_jobs = True):
+        '''Hands a job to every worker, replacing whatever they were mining.'''
+        message = (job.params(), extranonce2_start, extranonce2_stride, clean_jobs)
+        with self._lock:
+            self._job_ids = (self._job_ids + [ job.id ])[-2:]
+        for job_queue in self._job_queues:
+            job_queue.put(message)
+
+    def shutdown(self):
+        '''Stops the current job and ends the worker processes.'''
+        for job_queue in self._job_queues:
+            job_queue.put(None)
+        for process in self._processes:
+            process.join()
+
+    def _collect(self):
+        while True:
+            message = self._result_queue.get()
+            if message[0] == 'share':
+                (kind, index, result) = message
+                log('Worker %d found share' % index, LEVEL_DEBUG)
+                try:
+                    self._on_share(result)
+                except Exception as e:
+                    log("ERROR: %s" % e, LEVEL_ERROR)
+
+            elif message[0] == 'hashes':
+                (kind, index, hashes, times) = message
+                self._worker_hashes[index] = hashes
+                last = self._worker_stage_times[index]
+                for (stage, (seconds, count)) in times.items():
+                    (last_seconds, last_count) = last.get(stage, (0.0, 0))
+                    if count > last_count:
+                        record_stage_time(stage, seconds - last_seconds, count - last_count)
+                self._worker_stage_times[index] = times
+
+            elif message[0] == 'hashrate':
+                (kind, index, job_id, hashrate, start_latency) = message
+                log('Worker %d hashrate: %s' % (index, human_readable_hashrate(hashrate)), LEVEL_DEBUG)
+                with self._lock:
+                    self._hashrates = dict((j, h) for (j, h) in self._hashrates.items() if j in self._job_ids)
+                    if job_id not in self._job_ids: continue
+                hashrates = self._hashrates.setdefault(job_id, [ ])
+                hashrates.append((hashrate, start_latency))
+                if len(hashrates) == self._workers:
+                    del self._hashrates[job_id]
+                    start_latencies = [ latency for (rate, latency) in hashrates if latency is not None ]
+                    self._on_hashrate(self._name, job_id, sum(rate for (rate, latency) in hashrates), max(start_latencies) if start_latencies else None)
+
+class DeviceWorker(object):
+    '''Thread that mines the current job on one FPGA hasher.
+
+    The thread lives as long as the worker; each set_job() stops the job it was
+    mining and starts a copy of the new one on the given extranonce2 partition.
+    With no device the thread mines in this process with the selected software
+    sha256d library.
+    '''
+
+    def __init__(self, name, device, on_share, on_hashrate = log_hashrate):
+        self._name = name
+        self._device = device
+        self._on_share = on_share
+        self._on_hashrate = on_hashrate
+        self._swap = JobSwap()
+        # Hashes done on finished jobs and the job being mined
+        self._lock = threading.Lock()
+        self._hash_total = 0
+        self._job = None
+
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    name = property(lambda s: s._name)
+    device = property(lambda s: s._device)
+
+    def hashes(self):
+        '''Total hashes done, live from the hasher's counter for an FPGA.'''
+        if self._device: return self._device.hashes()
+        with self._lock:
+            return self._hash_total + (self._job.hash_count if self._job else 0)
+
+    def set_job(self, job, extranonce2_start = 0, extranonce2_stride = 1, clean_jobs = True):
+        '''Replaces the job being mined.'''
+        self._swap.put(job.copy(), extranonce2_start, extranonce2_stride, clean = clean_jobs)
+
+    def shutdown(self):
+        '''Stops the current job and ends the thread.'''
+        self._swap.shutdown()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            taken = self._swap.take()
+            if taken is None: return
+            (job, (extranonce2_start, extranonce2_stride)) = taken
+            with self._lock:
+                self._job = job
+
+            try:
+                for result in job.mine(extranonce2_start = extranonce2_start, extranonce2_stride = extranonce2_stride, device = self._device):
+                    if not job.stale: self._on_share(result)
+                self._on_hashrate(self._name, job.id, job.hashrate, job.start_latency)
+                if self._device:
+                    log("FPGA %s %s" % (self._name, self._device.wait_report()), LEVEL_INFO)
+            except Exception as e:
+                log("ERROR: %s: %s" % (self._name, e), LEVEL_ERROR)
+
+            with self._lock:
+                self._hash_total += job.hash_count
+                self._job = None
+
+class DeviceScheduler(object):
+    '''Mines each job on several devices at once.
+
+    Device i of N mines extranonce2 i, i + N, i + 2N, ... so no two devices hash the
+    same header. Devices are FPGA hashers or a CPU mining thread (DeviceWorker), or
+    a pool of CPU processes (WorkerPool); all of them live as long as the scheduler.
+    Shares from every device go to on_share. Each device's hashrate is logged when
+    it leaves a job, and the total once all of them have, with the time from the
+    mining.notify until the slowest device began hashing the job.
+    '''
+
+    def __init__(self, on_share):
+        self._on_share = on_share
+        self._devices = [ ]
+        self._lock = threading.Lock()
+        self._hashrates = dict()
+        # The two newest job ids; devices report a job as they leave it for the next one, and the
+        # hashrates of older jobs are dropped since devices that never took them never report them
+        self._job_ids = [ ]
+        self._throughput = dict()
+        # Delay from mining.notify to the job hashing on every device (total, max, jobs)
+        self._start_latency_total = 0.0
+        self._start_latency_max = 0.0
+        self._start_latency_count = 0
+
+    devices = property(lambda s: list(s._devices))
+
+    def start_latency(self):
+        '''The notify->first hash delay over the jobs every device started: (total seconds, jobs, max seconds).'''
+        with self._lock:
+            return (self._start_latency_total, self._start_latency_count, self._start_latency_max)
+
+    def add_fpga(self, device):
+        '''Adds an FPGA hasher, mined from its own thread.'''
+        name = 'fpga@0x%08x' % device.base_addr
+        self._devices.append(DeviceWorker(name, device, self._on_share, self._report_hashrate))
+
+    def add_thread(self):
+        '''Adds a mining thread in this process, using the selected software sha256d library.'''
+        self._devices.append(DeviceWorker('cpu/%s' % SHA256D_LIBRARY, None, self._on_share, self._report_hashrate))
+
+    def add_workers(self, workers, library):
+        '''Adds a pool of CPU mining processes using a software sha256d library.'''
+        self._devices.append(WorkerPool(workers, library, self._on_share, self._report_hashrate, name = 'cpu/%s' % library))
+
+    def set_job(self, job, clean_jobs = True):
+        '''Gives every device its extranonce2 partition of a new job.'''
+        with self._lock:
+            self._job_ids = (self._job_ids + [ job.id ])[-2:]
+            self._hashrates = dict((j, h) for (j, h) in self._hashrates.items() if j in self._job_ids)
+        for (index, device) in enumerate(self._devices):
+            device.set_job(job, extranonce2_start = index, extranonce2_stride = len(self._devices), clean_jobs = clean_jobs)
+
+    def throughput(self):
+        '''The hashrate of each device on the last job it finished.'''
+        with self._lock:
+            return dict(self._throughput)
+
+    def shutdown(self):
+        for device in self._devices:
+            device.shutdown()
+
+    def _report_hashrate(self, name, job_id, hashrate, start_latency):
+        log("Hashrate [%s]: %s" % (name, human_readable_hashrate(hashrate)), LEVEL_INFO)
+        with self._lock:
+            self._throughput[name] = hashrate
+            if job_id not in self._job_ids: return
+            hashrates = self._hashrates.setdefault(job_id, dict())
+            hashrates[name] = (hashrate, start_latency)
+            if len(hashrates) < len(self._devices): return
+            del self._hashrates[job_id]
+
+            # A job some device never started (replaced too quickly) has no latency
+            start_latencies = [ latency for (rate, latency) in hashrates.values() ]
+            if None in start_latencies:
+                report = 'not started on every device'
+            else:
+                start_latency = max(start_latencies)
+                self._start_latency_total += start_latency
+                self._start_latency_max = max(self._start_latency_max, start_latency)
+                self._start_latency_count += 1
+                report = '%.2fms mean=%.2fms max=%.2fms' % (1000 * start_latency, 1000 * self._start_latency_total / self._start_latency_count, 1000 * self._start_latency_max)
+        log("Hashrate: %s (notify->first hash %s)" % (human_readable_hashrate(sum(rate for (rate, latency) in hashrates.values())), report), LEVEL_INFO)
+
+class ShareSubmitter(object):
+    '''Submits shares from its own thread, in the order they were found.
+
+    put() only queues the share, so the hashing threads never wait on the
+    connection; submit(result) is called for each share on the submission thread.
+    '''
+
+    def __init__(self, submit):
+        self._submit = submit
+        self._queue = queue.Queue()
+        # Time shares spent queued before being written (total, number of shares)
+        self._queue_time = 0.0
+        self._count = 0
+
+        thread = threading.Thread(target = self._run)
+        thread.daemon = True
+        thread.start()
+
+    count = property(lambda s: s._count)
+
+    def put(self, result):
+        self._queue.put((time.time(), result))
+
+    def _run(self):
+        while True:
+            (found_time, result) = self._queue.get()
+            self._queue_time += time.time() - found_time
+            self._count += 1
+            try:
+                self._submit(result)
+            except Exception as e:
+                log("ERROR: Failed to submit share: %s" % e, LEVEL_ERROR)
+
+    def queue_time(self):
+        '''Mean time from a share being found to it being written.'''
+        return self._queue_time / self._count if self._count else 0.0
+
 class SimpleJsonRpcClient(object):
     '''Simple JSON-RPC client.
 
@@ -416,6 +1251,8 @@ class SimpleJsonRpcClient(object):
         self._rpc_thread = None
         self._message_id = 1
         self._requests = dict()
+        self._line_time = None
+        self._request_time = None
 
 
     def _handle_incoming_rpc(self):
@@ -429,27 +1266,36 @@ class SimpleJsonRpcClient(object):
                 data += chunk
                 continue
 
-            log('JSON-RPC Server > ' + line, LEVEL_PROTOCOL)
+            with self._lock:
+                self._handle_line(line)
 
-            # Parse the JSON
-            try:
-                reply = json.loads(line)
-            except Exception as e:
-                log("JSON-RPC Error: Failed to parse JSON %r (skipping)" % line, LEVEL_ERROR)
-                continue
+    def _handle_line(self, line):
+        '''Parses one line from the server and passes it to handle_reply.'''
+        # Time the line was framed, so handlers can measure their latency
+        self._line_time = time.time()
 
-            try:
-                request = None
+        log('JSON-RPC Server > ' + line, LEVEL_PROTOCOL)
+
+        # Parse the JSON
+        try:
+            reply = json.loads(line)
+        except Exception as e:
+            log("JSON-RPC Error: Failed to parse JSON %r (skipping)" % line, LEVEL_ERROR)
+            return
+
+        try:
+            # A reply retires its request; _request_time is when the request was sent
+            (request, self._request_time) = (None, None)
+            if reply.get('id') is not None:
                 with self._lock:
-                    if 'id' in reply and reply['id'] in self._requests:
-                        request = self._requests[reply['id']]
-                    self.handle_reply(request = request, reply = reply)
-            except self.RequestReplyWarning as e:
-                output = e.message
-                if e.request:
-                    output += '\n  ' + e.request
-                output += '\n  ' + e.reply
-                log(output, LEVEL_ERROR)
+                    (request, self._request_time) = self._requests.pop(reply['id'], (None, None))
+            self.handle_reply(request = request, reply = reply)
+        except self.RequestReplyWarning as e:
+            output = str(e)
+            if e.request:
+                output += '\n  ' + json.dumps(e.request)
+            output += '\n  ' + json.dumps(e.reply)
+            log(output, LEVEL_ERROR)
 
     def handle_reply(self, request, reply):
         # Override this method in sub-classes to handle a message from the server
@@ -460,11 +1306,11 @@ class SimpleJsonRpcClient(object):
         if not self._socket:
             raise self.ClientException('Not connected')
 
-        request = dict(id = self._message_id, method = method, params = params)
-        message = json.dumps(request)
-        message += '\n'
         with self._lock:
-            self._requests[self._message_id] = request
+            request = dict(id = self._message_id, method = method, params = params)
+            message = json.dumps(request)
+            message += '\n'
+            self._requests[self._message_id] = (request, time.time())
             self._message_id += 1
             self._socket.send(message.encode())
 
@@ -482,6 +1328,75 @@ class SimpleJsonRpcClient(object):
         self._rpc_thread.daemon = True
         self._rpc_thread.start()
 
+class AsyncJsonRpcClient(SimpleJsonRpcClient):
+    '''JSON-RPC client on an asyncio event loop.
+
+    Used like SimpleJsonRpcClient. The connection is served by an event loop in its
+    own thread, which frames lines as bytes with a StreamReader and calls
+    handle_reply without holding the client lock. send() queues the message on
+    the loop and returns without touching the socket, so the mining threads never
+    block on the network or on a handler.
+    '''
+
+    # Longest line accepted from the server (a mining.notify is a few kilobytes)
+    LINE_LIMIT = 1 << 20
+
+    def _run_loop(self, connected):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._handle_incoming_rpc(connected))
+
+    async def _handle_incoming_rpc(self, connected):
+        try:
+            (reader, self._writer) = await asyncio.open_connection(sock = self._socket, limit = self.LINE_LIMIT)
+        finally:
+            connected.set()
+
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                log("JSON-RPC Error: Line longer than %d bytes (skipping)" % self.LINE_LIMIT, LEVEL_ERROR)
+                continue
+            if not line:
+                log("JSON-RPC Error: Connection closed by the server", LEVEL_ERROR)
+                return
+
+            self._handle_line(line.decode().rstrip('\r\n'))
+
+    def send(self, method, params):
+        '''Queues a message to the JSON-RPC server; the event loop writes it.'''
+        if not self._writer:
+            raise self.ClientException('Not connected')
+
+        with self._lock:
+            request = dict(id = self._message_id, method = method, params = params)
+            self._requests[self._message_id] = (request, time.time())
+            self._message_id += 1
+        message = json.dumps(request) + '\n'
+        self._loop.call_soon_threadsafe(self._writer.write, message.encode())
+
+        log('JSON-RPC Server < ' + message, LEVEL_PROTOCOL)
+
+        return request
+
+    def connect(self, socket):
+        '''Connects to a remote JSON-RPC server, returning once the event loop owns the socket'''
+        if self._rpc_thread:
+            raise self.ClientException('Already connected')
+
+        self._socket = socket
+        self._socket.setblocking(False)
+        self._loop = asyncio.new_event_loop()
+        self._writer = None
+
+        connected = threading.Event()
+        self._rpc_thread = threading.Thread(target = self._run_loop, args = (connected, ))
+        self._rpc_thread.daemon = True
+        self._rpc_thread.start()
+        connected.wait()
+        if not self._writer:
+            raise self.ClientException('Failed to start the event loop')
+
 # Miner client
 class Miner(SimpleJsonRpcClient):
     '''Simple mining client'''
@@ -492,24 +1407,54 @@ class Miner(SimpleJsonRpcClient):
 
     class MinerAuthenticationException(SimpleJsonRpcClient.RequestReplyException): pass
 
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, workers = 1, cpu_workers = 0, cpu_library = SHA256D_LIBRARY_MIDSTATE, version_rolling = False, ntime_roll = 0):
         SimpleJsonRpcClient.__init__(self)
 
         self._url = url
         self._username = username
         self._password = password
+        # CPU processes for a software library, or alongside the FPGA hashers
+        self._workers = workers
+        self._cpu_workers = cpu_workers
+        self._cpu_library = cpu_library
+        # Negotiate rolling the version bits (BIP 310) before subscribing
+        self._version_rolling = version_rolling
 
         self._subscription = SubscriptionSHA256D()
+        self._subscription.set_ntime_roll(ntime_roll)
 
         self._job = None
+        self._scheduler = None
+
+        # Jobs the pool still accepts shares for; a new block or clean_jobs starts a
+        # new generation and every job from an earlier one is stale
+        self._prevhash = None
+        self._generation = 0
+        self._job_generations = dict()
 
         self._accepted_shares = 0
+        self._rejected_shares = 0
+        self._stale_shares = 0
+        self._rejected_stale_shares = 0
+        # Round trip from writing a mining.submit to the pool's reply (total, max)
+        self._submit_rtt_total = 0.0
+        self._submit_rtt_max = 0.0
+
+        self._submitter = ShareSubmitter(self._send_share)
 
     # Accessors
     url = property(lambda s: s._url)
     username = property(lambda s: s._username)
     password = property(lambda s: s._password)
 
+    scheduler = property(lambda s: s._scheduler)
+    accepted_shares = property(lambda s: s._accepted_shares)
+    rejected_shares = property(lambda s: s._rejected_shares)
+    stale_shares = property(lambda s: s._stale_shares)
+    rejected_stale_shares = property(lambda s: s._rejected_stale_shares)
+    # Submit round trips: (total seconds, replies, max seconds)
+    submit_rtt = property(lambda s: (s._submit_rtt_total, s._accepted_shares + s._rejected_shares, s._submit_rtt_max))
+
     # Overridden from SimpleJsonRpcClient
     def handle_reply(self, request, reply):
 
@@ -519,9 +1464,13 @@ class Miner(SimpleJsonRpcClient):
                 raise self.MinerWarning('Malformed mining.notify message', reply)
 
             (job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs) = reply['params']
-            self._spawn_job_thread(job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime)
+            try:
+                self._set_job(job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs)
+            except (TypeError, ValueError) as e:
+                # the fields are decoded as the job is created, a bad one drops the notify
+                raise self.MinerWarning('Malformed mining.notify message (%s)' % e, reply)
 
-            log('New job: job_id=%s' % job_id, LEVEL_DEBUG)
+            log('New job: job_id=%s generation=%d (%.3fms after receipt)' % (job_id, self._generation, 1000 * (time.time() - self._line_time)), LEVEL_DEBUG)
 
         # The server wants us to change our difficulty (on all *future* work)
         elif reply.get('method') == 'mining.set_difficulty':
@@ -533,11 +1482,45 @@ class Miner(SimpleJsonRpcClient):
 
             log('Change difficulty: difficulty=%s' % difficulty, LEVEL_DEBUG)
 
+        # The server changed the version bits we may roll (on all *future* work)
+        elif reply.get('method') == 'mining.set_version_mask':
+            if 'params' not in reply or len(reply['params']) != 1:
+                raise self.MinerWarning('Malformed mining.set_version_mask message', reply)
+
+            (version_mask, ) = reply['params']
+            try:
+                version_mask = parse_version_mask(version_mask)
+            except ValueError as e:
+                raise self.MinerWarning('Malformed mining.set_version_mask message (%s)' % e, reply)
+            self._subscription.set_version_mask(version_mask & VERSION_ROLLING_MASK if self._version_rolling else 0)
+
+            log('Change version mask: version_mask=%08x' % self._subscription.version_mask, LEVEL_DEBUG)
+
         # This is a reply to...
         elif request:
 
+            # ...configure; roll the version bits both we and the server allow
+            if request.get('method') == 'mining.configure':
+                # a server without BIP 310 answers with an error (or no result at all)
+                result = reply.get('result')
+                if reply.get('error') or not isinstance(result, dict):
+                    log('Version rolling: not supported by the server (%s)' % (reply.get('error') or 'no result'), LEVEL_INFO)
+
+                elif result.get('version-rolling') is True and 'version-rolling.mask' in result:
+                    try:
+                        version_mask = parse_version_mask(result['version-rolling.mask'])
+                    except ValueError as e:
+                        # mine without rolling rather than with bits the server may not allow
+                        self._subscription.set_version_mask(0)
+                        log('Version rolling: not supported, malformed mask from the server (%s)' % e, LEVEL_INFO)
+                    else:
+                        self._subscription.set_version_mask(version_mask & VERSION_ROLLING_MASK)
+                        log('Version rolling: version_mask=%08x' % self._subscription.version_mask, LEVEL_INFO)
+                else:
+                    log('Version rolling: not supported by the server', LEVEL_INFO)
+
             # ...subscribe; set-up the work and request authorization
-            if request.get('method') == 'mining.subscribe':
+            elif request.get('method') == 'mining.subscribe':
                 if 'result' not in reply or len(reply['result']) != 3 or len(reply['result'][0]) != 2:
                     raise self.MinerWarning('Reply to mining.subscribe is malformed', reply, request)
 
@@ -562,12 +1545,20 @@ class Miner(SimpleJsonRpcClient):
 
             # ...submit; complain if the server didn't accept our submission
             elif request.get('method') == 'mining.submit':
+                rtt = self._line_time - self._request_time
+                self._submit_rtt_total += rtt
+                self._submit_rtt_max = max(self._submit_rtt_max, rtt)
+
                 if 'result' not in reply or not reply['result']:
+                    self._rejected_shares += 1
+                    # stratum error 21 is "Job not found", a share that went stale on the way
+                    if isinstance(reply.get('error'), list) and reply['error'][:1] == [ 21 ]:
+                        self._rejected_stale_shares += 1
                     log('Share - Invalid', LEVEL_INFO)
                     raise self.MinerWarning('Failed to accept submit', reply, request)
 
                 self._accepted_shares += 1
-                log('Accepted shares: %d' % self._accepted_shares, LEVEL_INFO)
+                log('Accepted shares: %d (%s)' % (self._accepted_shares, self.submit_report(rtt)), LEVEL_INFO)
 
             # ??? *shrug*
             else:
@@ -577,13 +1568,12 @@ class Miner(SimpleJsonRpcClient):
         else:
             raise self.MinerWarning('Bad message state', reply)
 
-    def _spawn_job_thread(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime):
-        '''Stops any previous job and begins a new job.'''
-        # Stop the old job (if any)
-        if self._job: self._job.stop()
+    def _set_job(self, job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs):
+        '''Hands a new job to the mining devices, which stop their previous job.
 
-        # Create the new job
-        self._job = self._subscription.create_job(
+        Raises ValueError or TypeError, before changing anything, if a field can't be decoded.
+        '''
+        job = self._subscription.create_job(
             job_id = job_id,
             prevhash = prevhash,
             coinb1 = coinb1,
@@ -591,22 +1581,82 @@ class Miner(SimpleJsonRpcClient):
             merkle_branches = merkle_branches,
             version = version,
             nbits = nbits,
-            ntime = ntime
+            ntime = ntime,
+            received = self._line_time
         )
 
-        def run(job):
-            try:
-                for result in job.mine():
-                    params = [ self._subscription.worker_name ] + [ result[k] for k in ('job_id', 'extranonce2', 'ntime', 'nonce') ]
-                    self.send(method = 'mining.submit', params = params)
-                    log("Found share: " + str(params), LEVEL_INFO)
-                log("Hashrate: %s" % human_readable_hashrate(job.hashrate), LEVEL_INFO)
-            except Exception as e:
-                log("ERROR: %s" % e, LEVEL_ERROR)
-
-        thread = threading.Thread(target = run, args = (self._job, ))
-        thread.daemon = True
-        thread.start()
+        # A new block makes the earlier jobs stale even if the pool didn't say so
+        if clean_jobs or prevhash != self._prevhash:
+            clean_jobs = True
+            self._generation += 1
+            # keep the previous generation so its late shares are recognized as stale
+            self._job_generations = dict((j, g) for (j, g) in self._job_generations.items() if g == self._generation - 1)
+        self._prevhash = prevhash
+        self._job_generations[job_id] = self._generation
+
+        self._job = job
+        self._scheduler.set_job(self._job, clean_jobs = clean_jobs)
+
+    def _create_scheduler(self):
+        '''Returns the DeviceScheduler with the mining devices, which run until the miner exits.'''
+        scheduler = DeviceScheduler(self._submit_share)
+        if SHA256D_LIBRARY == SHA256D_LIBRARY_FPGA:
+            for device in fpga_devices:
+                scheduler.add_fpga(device)
+            if self._cpu_workers > 0:
+                scheduler.add_workers(self._cpu_workers, self._cpu_library)
+        elif self._workers == 1:
+            scheduler.add_thread()
+        else:
+            scheduler.add_workers(self._workers, SHA256D_LIBRARY)
+        return scheduler
+
+    def _submit_share(self, result):
+        '''Queues a share found by one of the mining threads or worker processes.'''
+        self._submitter.put(result)
+
+    def _drop_stale(self, result):
+        '''Counts and logs a share whose job is from an earlier generation, returns whether it was stale.'''
+        generation = self._job_generations.get(result['job_id'])
+        if generation == self._generation:
+            return False
+        self._stale_shares += 1
+        log("Stale share dropped: job_id=%s generation=%s current=%d (%s)" % (result['job_id'], generation, self._generation, self.stale_report()), LEVEL_INFO)
+        return True
+
+    def _send_share(self, result):
+        '''Sends a queued share to the pool, on the submission thread, unless its job is stale.'''
+        if self._drop_stale(result):
+            return
+
+        params = [ self._subscription.worker_name ] + [ result[k] for k in ('job_id', 'extranonce2', 'ntime', 'nonce') ]
+        # the rolled version bits, with mining.configure's version-rolling extension
+        if 'version_bits' in result:
+            params.append(result['version_bits'])
+        self.send(method = 'mining.submit', params = params)
+        log("Found share: " + str(params), LEVEL_INFO)
+
+    def stale_report(self):
+        '''Summarizes the shares dropped as stale and the ones the pool rejected as stale.'''
+        found = self._submitter.count
+        stale_rate = 100.0 * self._stale_shares / found if found else 0.0
+        return 'stale=%d (%.1f%% of found) rejected stale=%d' % (self._stale_shares, stale_rate, self._rejected_stale_shares)
+
+    def submit_report(self, rtt):
+        '''Summarizes the share round trip times, rtt being the latest.'''
+        replies = self._accepted_shares + self._rejected_shares
+        rtt_mean = self._submit_rtt_total / replies if replies else 0.0
+        return 'rejected=%d %s submit->reply=%.1fms mean=%.1fms max=%.1fms queued mean=%.3fms' % (self._rejected_shares, self.stale_report(), 1000 * rtt, 1000 * rtt_mean, 1000 * self._submit_rtt_max, 1000 * self._submitter.queue_time())
+
+    def _start_mining(self):
+        '''Starts the mining devices, which wait for the first job, and the metrics.'''
+        self._scheduler = self._create_scheduler()
+        log('Mining on %s' % ', '.join(device.name for device in self._scheduler.devices), LEVEL_INFO)
+
+        metrics = MinerMetrics(self, METRICS_INTERVAL)
+        if METRICS_PORT is not None:
+            metrics.serve(METRICS_PORT)
+            log('Serving metrics on http://127.0.0.1:%d/metrics' % METRICS_PORT, LEVEL_INFO)
 
     def serve_forever(self):
         '''Begins the miner. This method does not return.'''
@@ -617,23 +1667,384 @@ class Miner(SimpleJsonRpcClient):
 
         log('Starting server on %s:%d' % (hostname, port), LEVEL_INFO)
 
+        self._start_mining()
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((hostname, port))
         self.connect(sock)
 
+        # Replies come in order, so the version mask is known before the first job
+        if self._version_rolling:
+            self.send(method = 'mining.configure', params = [ [ 'version-rolling' ], { 'version-rolling.mask': '%08x' % VERSION_ROLLING_MASK, 'version-rolling.min-bit-count': VERSION_ROLLING_MIN_BIT_COUNT } ])
+
         self.send(method = 'mining.subscribe', params = [ "%s/%s" % (USER_AGENT, '.'.join(str(p) for p in VERSION)) ])
 
         # Forever...
         while True:
             time.sleep(10)
 
-def test_subscription(library):
-    '''Test harness for mining, using a known valid share.'''
-  
-    log('TEST: Sha256d implementation = %r' % library, LEVEL_INFO)
-    time.sleep(2)
-    log('TEST: Testing Subscription', LEVEL_DEBUG)
+class MinerMetrics(object):
+    '''Live metrics of a running Miner.
+
+    Every interval seconds each device's hash counter is sampled (the hardware
+    counter for an FPGA hasher), which gives its hashrate without waiting for a
+    job to end, and a summary is logged. serve(port) also publishes the metrics in
+    the Prometheus text format on http://127.0.0.1:port/metrics.
+    '''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log('Metrics request: ' + format % args, LEVEL_DEBUG)
+
+    def __init__(self, miner, interval = METRICS_INTERVAL):
+        self._miner = miner
+        self._interval = interval
+        # Device name -> hashes at the last sample, and hashrate between the last two samples
+        self._hashes = dict()
+        self._hashrates = dict()
+        self._sample_time = None
+
+        self.sample()
+        thread = threading.Thread(target = self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self.sample()
+            log('Metrics: ' + self.report(), LEVEL_INFO)
+
+    def _devices(self):
+        return self._miner.scheduler.devices
+
+    def _program_time(self):
+        '''FPGA register programming over all hashers: (total seconds, work units).'''
+        devices = [ worker.device for worker in self._devices() if isinstance(worker, DeviceWorker) and worker.device ]
+        return (sum(device.program_time for device in devices), sum(device.program_count for device in devices))
+
+    def sample(self):
+        '''Reads every device's hash counter and updates the hashrates.'''
+        now = time.time()
+        for device in self._devices():
+            hashes = device.hashes()
+            if self._sample_time is not None:
+                self._hashrates[device.name] = (hashes - self._hashes.get(device.name, 0)) / (now - self._sample_time)
+            self._hashes[device.name] = hashes
+        self._sample_time = now
+
+    def report(self):
+        '''One line summary of the last sample.'''
+        miner = self._miner
+        (latency_total, latency_count, latency_max) = miner.scheduler.start_latency()
+        times = stage_times()
+        stages = [ (stage, ) + tuple(times[stage]) for stage in ('merkle', 'midstate') ] + [ ('program', ) + self._program_time() ]
+        return 'hashrate=%s [%s] shares accepted=%d rejected=%d stale=%d job switch mean=%.2fms max=%.2fms prepare %s' % (
+            human_readable_hashrate(sum(self._hashrates.values())),
+            ', '.join('%s %s' % (name, human_readable_hashrate(hashrate)) for (name, hashrate) in sorted(self._hashrates.items())),
+            miner.accepted_shares, miner.rejected_shares, miner.stale_shares,
+            1000 * latency_total / latency_count if latency_count else 0.0, 1000 * latency_max,
+            ' '.join('%s=%.1fus' % (stage, 1e6 * seconds / count if count else 0.0) for (stage, seconds, count) in stages))
+
+    def render(self):
+        '''The metrics in the Prometheus text exposition format.'''
+        miner = self._miner
+        lines = [ ]
+        def metric(name, kind, description, samples):
+            lines.append('# HELP fpgaminer_%s %s' % (name, description))
+            lines.append('# TYPE fpgaminer_%s %s' % (name, kind))
+            for (labels, value) in samples:
+                lines.append('fpgaminer_%s%s %s' % (name, labels, value))
+
+        devices = self._devices()
+        metric('hashrate', 'gauge', 'Hashes per second between the last two samples.', [ ('{device="%s"}' % name, hashrate) for (name, hashrate) in sorted(self._hashrates.items()) ])
+        metric('hashes_total', 'counter', 'Hashes done by each device.', [ ('{device="%s"}' % device.name, device.hashes()) for device in devices ])
+        metric('shares_total', 'counter', 'Shares found, by outcome; stale shares are dropped before submitting.', [ ('{result="accepted"}', miner.accepted_shares), ('{result="rejected"}', miner.rejected_shares), ('{result="stale"}', miner.stale_shares) ])
+        metric('shares_rejected_stale_total', 'counter', 'Rejected shares the pool reported as stale.', [ ('', miner.rejected_stale_shares) ])
+
+        (latency_total, latency_count, latency_max) = miner.scheduler.start_latency()
+        metric('job_switch_seconds', 'summary', 'Delay from a mining.notify until every device hashes the job.', [ ('_sum', latency_total), ('_count', latency_count) ])
+        metric('job_switch_seconds_max', 'gauge', 'Longest delay from a mining.notify until every device hashes the job.', [ ('', latency_max) ])
+
+        (rtt_total, rtt_count, rtt_max) = miner.submit_rtt
+        metric('submit_rtt_seconds', 'summary', 'Round trip from writing a mining.submit to the reply.', [ ('_sum', rtt_total), ('_count', rtt_count) ])
+
+        times = stage_times()
+        stages = [ (stage, ) + tuple(times[stage]) for stage in ('merkle', 'midstate') ] + [ ('program', ) + self._program_time() ]
+        metric('stage_seconds_total', 'counter', 'Time spent building merkle roots and midstates and programming the FPGA registers.', [ ('{stage="%s"}' % stage, seconds) for (stage, seconds, count) in stages ])
+        metric('stage_runs_total', 'counter', 'Merkle roots and midstates built, and FPGA work units programmed.', [ ('{stage="%s"}' % stage, count) for (stage, seconds, count) in stages ])
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        '''Serves the metrics over HTTP on localhost from a background thread.'''
+        server = http.server.HTTPServer(('127.0.0.1', port), self.Handler)
+        server.metrics = self
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+class AsyncMiner(Miner, AsyncJsonRpcClient):
+    '''Mining client on the asyncio transport'''
+    pass
+
+# Stratum transports, see --transport
+TRANSPORT_THREAD = 'thread'
+TRANSPORT_ASYNCIO = 'asyncio'
+MINERS = { TRANSPORT_THREAD: Miner, TRANSPORT_ASYNCIO: AsyncMiner }
+
+# Solo mining against bitcoind's getblocktemplate (see SoloMiner)
+BITCOIND_PORT = 8332
+# Seconds to wait on a bitcoind call, except long polls which wait for a new template
+BITCOIND_TIMEOUT = 30
+# Seconds between getblocktemplate calls if bitcoind doesn't long poll, and after a failed call
+GBT_POLL_INTERVAL = 5
+# submitblock's reasons for a block that doesn't build on the best chain
+BLOCK_STALE_REASONS = ( 'inconclusive-not-best-prevblk', 'stale-prevblk' )
+# The coinbase's extranonce: no extranonce1 and the 4 bytes Job.work_units packs extranonce2 into
+SOLO_EXTRANONCE2_SIZE = 4
+# Templates of the current tip kept for the blocks still being found on them, each holds every transaction
+SOLO_TEMPLATES_KEPT = 4
+
+def varint(n):
+    '''Bitcoin's variable length integer (CompactSize).'''
+    if n < 0xfd: return bytes([ n ])
+    if n <= 0xffff: return b'\xfd' + struct.pack('<H', n)
+    if n <= 0xffffffff: return b'\xfe' + struct.pack('<I', n)
+    return b'\xff' + struct.pack('<Q', n)
+
+def script_number(n):
+    '''The script push of a non-negative number, as BIP 34 puts the block height in the coinbase.'''
+    if n == 0: return b'\x00'
+    if n <= 16: return bytes([ 0x50 + n ])
+    data = n.to_bytes((n.bit_length() + 8) // 8, 'little')
+    return bytes([ len(data) ]) + data
+
+def coinbase_parts(height, value, script_pubkey, witness_commitment = None, tag = b''):
+    '''Splits a coinbase transaction around its extranonce, returning (coinb1, coinb2) as bytes.
+
+    The scriptSig is the BIP 34 height, a push of the SOLO_EXTRANONCE2_SIZE extranonce
+    bytes and a push of tag; value goes to script_pubkey. witness_commitment is the
+    script of the segwit commitment output (getblocktemplate's default_witness_commitment).
+    '''
+    script_sig_head = script_number(height) + bytes([ SOLO_EXTRANONCE2_SIZE ])
+    script_sig_tail = bytes([ len(tag) ]) + tag
+    script_sig_size = len(script_sig_head) + SOLO_EXTRANONCE2_SIZE + len(script_sig_tail)
+    outputs = [ struct.pack('<q', value) + varint(len(script_pubkey)) + script_pubkey ]
+    if witness_commitment is not None:
+        outputs.append(struct.pack('<q', 0) + varint(len(witness_commitment)) + witness_commitment)
+
+    coinb1 = struct.pack('<i', 1) + varint(1) + bytes(32) + b'\xff\xff\xff\xff' + varint(script_sig_size) + script_sig_head
+    coinb2 = script_sig_tail + b'\xff\xff\xff\xff' + varint(len(outputs)) + b''.join(outputs) + struct.pack('<I', 0)
+    return (coinb1, coinb2)
+
+def coinbase_with_witness(coinbase_bin):
+    '''The segwit serialization of a coinbase, with the 32 zero byte witness reserved value.'''
+    return coinbase_bin[:4] + b'\x00\x01' + coinbase_bin[4:-4] + b'\x01\x20' + bytes(32) + coinbase_bin[-4:]
+
+class BitcoindRpc(object):
+    '''JSON-RPC client of bitcoind over HTTP, a connection per call so threads can call at once.'''
+
+    class RpcError(Exception): pass
+
+    def __init__(self, url, username, password):
+        url = urllib.parse.urlparse(url)
+        self._host = url.hostname or '127.0.0.1'
+        self._port = url.port or BITCOIND_PORT
+        self._authorization = 'Basic ' + base64.b64encode(('%s:%s' % (username, password)).encode()).decode()
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def call(self, method, *params, timeout = BITCOIND_TIMEOUT):
+        '''Returns the result of a call, raising RpcError for an error reply and OSError if bitcoind is unreachable.'''
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        body = json.dumps(dict(jsonrpc = '1.0', id = message_id, method = method, params = list(params)))
+        log('JSON-RPC Client > %s' % body, LEVEL_PROTOCOL)
+
+        connection = http.client.HTTPConnection(self._host, self._port, timeout = timeout)
+        try:
+            connection.request('POST', '/', body, { 'Authorization': self._authorization, 'Content-Type': 'application/json' })
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        log('JSON-RPC Server > %s' % data.decode(errors = 'replace'), LEVEL_PROTOCOL)
+
+        # bitcoind answers errors with an HTTP error status and a JSON-RPC error
+        try:
+            reply = json.loads(data)
+        except ValueError:
+            raise self.RpcError('%s: HTTP %d %s' % (method, response.status, response.reason))
+        if reply.get('error'):
+            raise self.RpcError('%s: %s' % (method, reply['error'].get('message', reply['error'])))
+        return reply['result']
+
+class SoloMiner(Miner):
+    '''Mines blocks of bitcoind's getblocktemplate instead of a pool's jobs.
+
+    The coinbase and merkle branches are built here and every template becomes a
+    Job for the DeviceScheduler, like a mining.notify. Templates are picked up with
+    long polls, and keep one merkle tree that each template only rehashes from its
+    first new transaction. A share is a block: it is submitted with submitblock,
+    and once accepted the next template is fetched right away, without waiting on
+    the long poll.
+    '''
+
+    def __init__(self, url, username, password, coinbase_address, workers = 1, cpu_workers = 0, cpu_library = SHA256D_LIBRARY_MIDSTATE, version_rolling = False, ntime_roll = 0, coinbase_tag = USER_AGENT):
+        Miner.__init__(self, url, username, password, workers, cpu_workers, cpu_library, version_rolling, ntime_roll)
+        self._coinbase_address = coinbase_address
+        self._coinbase_tag = coinbase_tag.encode()
+        self._rpc = BitcoindRpc(url, username, password)
+        self._script_pubkey = None
+
+        # Transactions of the latest template, the coinbase is a placeholder as the branches don't depend on it
+        self._merkle_tree = merkle.MerkleTree([ bytes(32) ])
+        # What _block_bin needs of the last SOLO_TEMPLATES_KEPT templates of the tip,
+        # job_id -> (version, previousblockhash, bits, segwit, coinb1, coinb2, branches, transaction count, transactions)
+        self._templates = dict()
+        self._job_counter = 0
+        # The long poll (main thread) and an accepted block (submission thread) both set templates
+        self._template_lock = threading.Lock()
+
+    def _get_template(self, longpollid = None):
+        '''Calls getblocktemplate, a long poll if longpollid is given.'''
+        params = dict(rules = [ 'segwit' ])
+        if longpollid is not None:
+            params['longpollid'] = longpollid
+        return self._rpc.call('getblocktemplate', params, timeout = None if longpollid else BITCOIND_TIMEOUT)
+
+    def _set_template(self, template):
+        '''Builds the coinbase and merkle branches of a template and mines it.'''
+        with self._template_lock:
+            received = time.time()
+            self._line_time = received
+
+            txids_bin = [ bytes(32) ] + [ bytes.fromhex(tx.get('txid', tx['hash']))[::-1] for tx in template['transactions'] ]
+            first = self._merkle_tree.update(txids_bin)
+            merkle_branches_bin = self._merkle_tree.path(0)
+
+            witness_commitment = bytes.fromhex(template['default_witness_commitment']) if 'default_witness_commitment' in template else None
+            (coinb1_bin, coinb2_bin) = coinbase_parts(template['height'], template['coinbasevalue'], self._script_pubkey, witness_commitment, self._coinbase_tag)
+
+            # stratum's prevhash is the hash in its internal byte order, each 4 byte word swapped
+            prevhash_bin = bytes.fromhex(template['previousblockhash'])[::-1]
+            prevhash = b''.join(prevhash_bin[4 * i: 4 * i + 4][::-1] for i in range(8)).hex()
+
+            self._job_counter += 1
+            job_id = '%x' % self._job_counter
+            transactions_bin = b''.join(bytes.fromhex(tx['data']) for tx in template['transactions'])
+            self._templates[job_id] = (template['version'], template['previousblockhash'], template['bits'], witness_commitment is not None, coinb1_bin, coinb2_bin, merkle_branches_bin, len(template['transactions']), transactions_bin)
+            self._subscription.set_target(int(template['target'], 16))
+            self._set_job(job_id, prevhash, coinb1_bin.hex(), coinb2_bin.hex(), [ b.hex() for b in merkle_branches_bin ], '%08x' % template['version'], template['bits'], '%08x' % template['curtime'], False)
+            # long polls on the same tip keep adding templates, only the last few of the tip are kept
+            self._templates = dict((j, t) for (j, t) in self._templates.items() if self._job_generations.get(j) == self._generation and int(j, 16) > self._job_counter - SOLO_TEMPLATES_KEPT)
+
+            log('New template: height=%d transactions=%d job_id=%s generation=%d (merkle tree rehashed from transaction %d, %.3fms after the reply)' % (template['height'], len(template['transactions']), job_id, self._generation, first, 1000 * (time.time() - received)), LEVEL_INFO)
+
+    def _block_bin(self, template, result):
+        '''Serializes the block of a share from what _set_template kept of its template.'''
+        (version, previousblockhash, bits, segwit, coinb1_bin, coinb2_bin, merkle_branches_bin, transaction_count, transactions_bin) = template
+        coinbase_bin = coinb1_bin + bytes.fromhex(result['extranonce2']) + coinb2_bin
+        merkle_root_bin = merkle.merkle_root_branches_bin(sha256d_hashlib(coinbase_bin), merkle_branches_bin)
+
+        version = (version & ~self._subscription.version_mask) | int(result.get('version_bits', '0'), 16)
+        header_bin = struct.pack('<I', version) + bytes.fromhex(previousblockhash)[::-1] + merkle_root_bin + swap_endian_word(result['ntime']) + swap_endian_word(bits) + swap_endian_word(result['nonce'])
+
+        if segwit:
+            coinbase_bin = coinbase_with_witness(coinbase_bin)
+        return header_bin + varint(1 + transaction_count) + coinbase_bin + transactions_bin
+
+    def _send_share(self, result):
+        '''Submits the block of a queued share, on the submission thread, unless its job is stale.'''
+        if self._drop_stale(result):
+            return
+        template = self._templates.get(result['job_id'])
+        if template is None:
+            self._stale_shares += 1
+            log('Stale block dropped: job_id=%s, %d newer templates replaced it (%s)' % (result['job_id'], SOLO_TEMPLATES_KEPT, self.stale_report()), LEVEL_INFO)
+            return
+
+        block_bin = self._block_bin(template, result)
+        block_hash = sha256d_hashlib(block_bin[:80])[::-1].hex()
+        log('Found block: %s %r' % (block_hash, result), LEVEL_INFO)
+
+        t0 = time.time()
+        try:
+            reason = self._rpc.call('submitblock', block_bin.hex())
+        except (OSError, BitcoindRpc.RpcError) as e:
+            reason = str(e)
+        rtt = time.time() - t0
+        self._submit_rtt_total += rtt
+        self._submit_rtt_max = max(self._submit_rtt_max, rtt)
+
+        # submitblock returns null for an accepted block, the reason otherwise
+        if reason is None:
+            self._accepted_shares += 1
+            log('Accepted blocks: %d (%s)' % (self._accepted_shares, self.submit_report(rtt)), LEVEL_INFO)
+            # mine on the new tip now, the long poll's template for it comes later
+            try:
+                self._set_template(self._get_template())
+            except (OSError, BitcoindRpc.RpcError) as e:
+                log('getblocktemplate failed: %s' % e, LEVEL_ERROR)
+        else:
+            self._rejected_shares += 1
+            # a block on the previous tip, found before the template of our last block came in
+            if reason in BLOCK_STALE_REASONS:
+                self._rejected_stale_shares += 1
+                log('Block %s went stale: %s (%s)' % (block_hash, reason, self.stale_report()), LEVEL_INFO)
+            else:
+                log('Block %s rejected: %s' % (block_hash, reason), LEVEL_ERROR)
+
+    def serve_forever(self):
+        '''Begins the miner, long polling bitcoind for templates. This method does not return.'''
+        log('Solo mining on bitcoind at %s' % self.url, LEVEL_INFO)
+
+        info = self._rpc.call('validateaddress', self._coinbase_address)
+        if not info.get('isvalid'):
+            raise self.ClientException('Invalid coinbase address %r' % self._coinbase_address)
+        self._script_pubkey = bytes.fromhex(info['scriptPubKey'])
 
+        self._subscription.set_subscription('solo', '', SOLO_EXTRANONCE2_SIZE)
+        # there's no pool to negotiate with, the BIP 320 bits are ours to roll
+        if self._version_rolling:
+            self._subscription.set_version_mask(VERSION_ROLLING_MASK)
+
+        self._start_mining()
+
+        longpollid = None
+        while True:
+            try:
+                template = self._get_template(longpollid)
+            except (OSError, BitcoindRpc.RpcError) as e:
+                log('getblocktemplate failed: %s' % e, LEVEL_ERROR)
+                longpollid = None
+                time.sleep(GBT_POLL_INTERVAL)
+                continue
+
+            self._set_template(template)
+            longpollid = template.get('longpollid')
+            if longpollid is None:
+                time.sleep(GBT_POLL_INTERVAL)
+
+# Block 123456 as a stratum job, with its nonce as the one known share (see test_job)
+TEST_NONCE = 0x913914e3
+
+def test_job():
+    '''Creates the job for block 123456, whose share is found at nonce TEST_NONCE.'''
     subscription = SubscriptionSHA256D()
 
     # Set up the subscription
@@ -652,7 +2063,7 @@ def test_subscription(library):
     reply = json.loads('{"id":null,"method":"mining.notify","params":["1d987a1338","3ac400955224c625ad00510bf9b92cf824fd72dabc96a44700000b6000000000","01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff0704b3936a1a017cffffffff01403d522a01000000434104563053b8900762f3d3e8725012d617d177e3c4af3275c3265a1908b434e0df91ec75603d0d8955ef040e5f68d5c36989efe21a59f4ef94a5cc95c99794a84492ac","",["b4839c227eb12a4682ef507024a44066d1b54b2a224cf4765bdd46b35a42d0e3", "ff55ad590268952712d3586af4f4619eb5f280ed671e2a7dca766076994e19ff", "d8adfb1856bc923a6da4e83914013405334915d4ece1eb36d09cef8119850ea4", "ce28b22ba91639d5ae35d0f7a17e02b422fa251c372cb600daf62b7f3df0bdbd"],"00000001","1a6a93b3","4dcbc8a6",true]}')
     log('TEST: %r' % reply, LEVEL_DEBUG)
     (job_id, prevhash, coinb1, coinb2, merkle_branches, version, nbits, ntime, clean_jobs) = reply['params']
-    job = subscription.create_job(
+    return subscription.create_job(
         job_id = job_id,
         prevhash = prevhash,
         coinb1 = coinb1,
@@ -663,15 +2074,160 @@ def test_subscription(library):
         ntime = ntime
     )
 
+def test_subscription(library):
+    '''Test harness for mining, using a known valid share.'''
+  
+    log('TEST: Sha256d implementation = %r' % library, LEVEL_INFO)
+    time.sleep(2)
+    log('TEST: Testing Subscription', LEVEL_DEBUG)
+
+    job = test_job()
+
     # Scan that job (if I broke something, this will run for a long time))
-    for result in job.mine(nonce_start = 2436437219 - 5):
+    for result in job.mine(nonce_start = TEST_NONCE - 5):
         log('TEST: found share - %r' % repr(result), LEVEL_INFO)
         break
 
     valid = { 'ntime': '4dcbc8a6', 'nonce': '913914e3', 'extranonce2': '00000000', 'job_id': u'1d987a1338' }
     log('TEST: Correct answer %r' % valid, LEVEL_INFO)
+
+    # The share must also be one by hashlib, which shares no code with the other implementations
+    header_bin = job.header_prefix_bin(bytes.fromhex(result['extranonce2'])) + struct.pack('<I', int(result['nonce'], 16))
+    passed = result == valid and int.from_bytes(sha256d_hashlib(header_bin), 'little') <= int(job.target, 16)
+    log('TEST: %s' % ('Passed' if passed else 'FAILED'), LEVEL_INFO if passed else LEVEL_ERROR)
     time.sleep(2)
 
+def test_device(bulk):
+    '''Test harness for the FPGA register programming, mining the known share on a simulated hasher.'''
+
+    log('TEST: Simulated FPGA hasher, %s register programming' % ('bulk' if bulk else 'per word'), LEVEL_INFO)
+
+    # the simulated hasher only hashes the few nonces before the share, not the 2^32 the hardware does
+    device = hasher_device.SimulatedHasherDevice(bulk = bulk, first_nonce = TEST_NONCE - 5)
+    job = test_job()
+    for result in job.mine(device = device):
+        log('TEST: found share - %r' % repr(result), LEVEL_INFO)
+        break
+    job.stop()
+
+    valid = { 'ntime': '4dcbc8a6', 'nonce': '913914e3', 'extranonce2': '00000000', 'job_id': u'1d987a1338' }
+    passed = result == valid and device.program_count == 1
+    log('TEST: %s' % ('Passed' if passed else 'FAILED'), LEVEL_INFO if passed else LEVEL_ERROR)
+
+# Benchmark workload: nonces each implementation mines, ending on TEST_NONCE (the FPGA
+# always starts at nonce 0), midstates each one computes, and merkle roots and headers built
+BENCHMARK_NONCES = {
+    SHA256D_LIBRARY_HASHLIB: 200000,
+    SHA256D_LIBRARY_MIDSTATE: 200000,
+    SHA256D_LIBRARY_PYTHON: 5000,
+    SHA256D_LIBRARY_NUMPY: 16 * 8192,
+    SHA256D_LIBRARY_FPGA: TEST_NONCE + 1
+}
+BENCHMARK_MIDSTATES = {
+    SHA256D_LIBRARY_MIDSTATE: 200000,
+    SHA256D_LIBRARY_PYTHON: 2000,
+    SHA256D_LIBRARY_NUMPY: 2000,
+    SHA256D_LIBRARY_FPGA: 2000
+}
+BENCHMARK_STAGE_COUNT = 50000
+# Runs of each measurement, the fastest counts, and the seconds each run repeats run() for
+BENCHMARK_REPEAT = 5
+BENCHMARK_WINDOW = 1.0
+# Fraction a rate may fall below the baseline before it is a regression, just above the
+# run to run noise of a dedicated machine. On a shared VM runs of an unchanged tree
+# measured up to ~30% apart, raise it there with --regression-threshold
+BENCHMARK_THRESHOLD = 0.10
+
+def benchmark_rate(count, run, repeat = BENCHMARK_REPEAT, window = BENCHMARK_WINDOW):
+    '''Operations per second of run(), which does count operations, best of repeat runs.
+
+    Each run calls run() at least once and until window seconds have passed, so
+    fast measurements aren't at the mercy of a single short timing.
+    '''
+    best = 0.0
+    for i in range(repeat):
+        (calls, t0) = (0, time.time())
+        while calls == 0 or time.time() - t0 < window:
+            run()
+            calls += 1
+        best = max(best, calls * count / (time.time() - t0))
+    return best
+
+def benchmark_startup(library):
+    '''Seconds a new interpreter takes to import the miner and initialize the implementation.'''
+    import subprocess
+    t0 = time.time()
+    subprocess.check_call([ sys.executable, '-c', 'import fpgaminer; fpgaminer.set_sha256d_library(%r)' % library ], cwd = sys.path[0] or None)
+    return time.time() - t0
+
+def benchmark(libraries):
+    '''Measures every sha256d implementation and the work preparation stages on the block 123456 job.
+
+    Returns { section: { metric: rate } } with a section per implementation (hashes
+    and midstates per second) and one for the stages the implementations share
+    (merkle roots and header prefixes per second).
+    '''
+    job = test_job()
+    extranonce2s = [ struct.pack('<I', i) for i in range(BENCHMARK_STAGE_COUNT) ]
+    results = dict(stages = dict(
+        merkle_roots_per_sec = benchmark_rate(len(extranonce2s), lambda: [ job.merkle_root_bin(e) for e in extranonce2s ]),
+        headers_per_sec = benchmark_rate(len(extranonce2s), lambda: [ job.header_prefix_bin(e) for e in extranonce2s ])
+    ))
+    log('Benchmark stages: %r' % results['stages'], LEVEL_INFO)
+
+    # What each implementation precomputes per header before scanning nonces
+    midstates = {
+        SHA256D_LIBRARY_MIDSTATE: sha256d_hashlib_midstate,
+        SHA256D_LIBRARY_PYTHON: sha256d_python_midstate,
+        SHA256D_LIBRARY_NUMPY: sha256d_midstate,
+        SHA256D_LIBRARY_FPGA: sha256d_midstate
+    }
+    # the header template the CPU loop hashes, its nonce is 0
+    header_view = memoryview(bytearray(job.header_prefix_bin(extranonce2s[0]) + bytes(4)))
+
+    for library in libraries:
+        try:
+            set_sha256d_library(library)
+        except ImportError as e:
+            log('Benchmark: skipping %s (%s)' % (library, e), LEVEL_ERROR)
+            continue
+
+        count = BENCHMARK_NONCES[library]
+        def scan():
+            result = next(test_job().mine(nonce_start = TEST_NONCE + 1 - count))
+            if int(result['nonce'], 16) != TEST_NONCE:
+                raise ValueError('%s found nonce %s instead of %08x' % (library, result['nonce'], TEST_NONCE))
+
+        rates = dict(hashes_per_sec = (benchmark_rate(count, scan, 1, 0) if library == SHA256D_LIBRARY_FPGA else benchmark_rate(count, scan)))
+        if library in midstates:
+            (midstate, count) = (midstates[library], BENCHMARK_MIDSTATES[library])
+            rates['midstates_per_sec'] = benchmark_rate(count, lambda: [ midstate(header_view) for i in range(count) ])
+        results[library] = rates
+        log('Benchmark %s: %r' % (library, rates), LEVEL_INFO)
+
+    return results
+
+def benchmark_startups(libraries):
+    '''Returns { library: { init_seconds, startup_seconds } }; lower is better, so these are kept out of the compared rates.'''
+    startups = dict()
+    for library in libraries:
+        if library not in sha256d_backends: continue
+        startups[library] = dict(init_seconds = sha256d_init_time(library), startup_seconds = benchmark_startup(library))
+        log('Benchmark %s startup: %r' % (library, startups[library]), LEVEL_INFO)
+    return startups
+
+def compare_benchmark(results, baseline, threshold = BENCHMARK_THRESHOLD):
+    '''Logs every rate against the baseline and returns the ones that fell more than threshold below it.'''
+    regressions = [ ]
+    for (section, rates) in sorted(results.items()):
+        for (name, rate) in sorted(rates.items()):
+            base = baseline.get(section, dict()).get(name)
+            if not base: continue
+            change = rate / base - 1
+            regressed = change < -threshold
+            log('Benchmark %s %s: %.1f baseline %.1f (%+.1f%%)%s' % (section, name, rate, base, 100 * change, ' REGRESSION' if regressed else ''), LEVEL_ERROR if regressed else LEVEL_INFO)
+            if regressed: regressions.append('%s.%s' % (section, name))
+    return regressions
 
 # CLI for mining
 if __name__ == '__main__':
@@ -685,15 +2241,36 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--pass', dest = 'password', default = '', help = 'password for mining server', metavar = "PASSWORD")
 
     parser.add_argument('-O', '--userpass', help = 'username:password pair for mining server', metavar = "USERNAME:PASSWORD")
+    parser.add_argument('--transport', default = TRANSPORT_ASYNCIO, choices = sorted(MINERS), help = 'stratum connection handling: an asyncio event loop or a blocking reader thread')
+    parser.add_argument('--ntime-roll', dest = 'ntime_roll', type = int, default = 0, help = 'seconds the block time may be rolled past the job\'s ntime, for more nonce ranges per merkle root (default 0)', metavar = "SECONDS")
+    parser.add_argument('--version-rolling', dest = 'version_rolling', action ='store_true', help = 'roll the block version bits (BIP 310/320) if the server allows it, several nonce ranges per merkle root')
+    parser.add_argument('--solo', action ='store_true', help = 'mine blocks of bitcoind\'s getblocktemplate at -o/--url (eg: http://127.0.0.1:8332) instead of a pool\'s jobs')
+    parser.add_argument('--coinbase-address', dest = 'coinbase_address', help = 'address the block reward of --solo is paid to', metavar = "ADDRESS")
+    parser.add_argument('--coinbase-tag', dest = 'coinbase_tag', default = USER_AGENT, help = 'text put in the coinbase of --solo blocks (default %s)' % USER_AGENT, metavar = "TAG")
 
     parser.add_argument('-i', '--impl', default = SHA256D_LIBRARY_AUTO, choices = list(set(SHA256D_LIBRARIES)), help = 'library implementation for sha256d')
 
+    parser.add_argument('-A', '--fpga-base-addr', dest = 'fpga_base_addrs', type = lambda addr: int(addr, 0), action = 'append', help = 'base address of an FPGA hasher, repeat for several hashers (default 0x%08x)' % hasher_device.BASE_ADDR, metavar = "ADDR")
+    parser.add_argument('--cpu-workers', dest = 'cpu_workers', type = int, default = 0, help = 'CPU mining processes to run alongside the FPGA hashers', metavar = "N")
+    parser.add_argument('--cpu-impl', dest = 'cpu_impl', default = SHA256D_LIBRARY_MIDSTATE, choices = [ SHA256D_LIBRARY_HASHLIB, SHA256D_LIBRARY_MIDSTATE, SHA256D_LIBRARY_PYTHON, SHA256D_LIBRARY_NUMPY ], help = 'library implementation for --cpu-workers')
+    parser.add_argument('-D', '--fpga-device', dest = 'fpga_device', default = FPGA_DEVICE_DRIVER, choices = sorted(hasher_device.HASHER_DEVICES), help = 'driver for the FPGA hasher registers')
+    parser.add_argument('--fpga-reload', dest = 'fpga_reload', action ='store_true', help = 'download the overlay bitstream even if the same one is already loaded')
+    parser.add_argument('-W', '--fpga-wait', dest = 'fpga_wait', default = FPGA_WAIT_STRATEGY, choices = hasher_device.WAIT_STRATEGIES, help = 'how to wait for the FPGA hasher to finish a nonce range')
+    parser.add_argument('--prefetch', type = int, default = FPGA_PREFETCH, help = 'FPGA work units to prepare ahead of the one hashing (0 to disable)', metavar = "N")
+    parser.add_argument('-b', '--batch-size', dest = 'batch_size', type = int, default = NUMPY_BATCH_SIZE, help = 'nonces hashed per batch by the numpy implementation', metavar = "N")
+    parser.add_argument('--metrics-interval', dest = 'metrics_interval', type = float, default = METRICS_INTERVAL, help = 'seconds between metrics samples and log lines', metavar = "SECONDS")
+    parser.add_argument('--metrics-port', dest = 'metrics_port', type = int, default = METRICS_PORT, help = 'serve Prometheus metrics on http://127.0.0.1:PORT/metrics', metavar = "PORT")
+    parser.add_argument('-w', '--workers', type = int, default = 1, help = 'number of mining processes for the CPU implementations', metavar = "N")
+
     parser.add_argument('-B', '--background', action ='store_true', help = 'run in the background as a daemon')
 
     parser.add_argument('-q', '--quiet', action ='store_true', help = 'suppress non-errors')
     parser.add_argument('-P', '--dump-protocol', dest = 'protocol', action ='store_true', help = 'show all JSON-RPC chatter')
     parser.add_argument('-d', '--debug', action ='store_true', help = 'show extra debug information')
-    parser.add_argument('-t', '--test', action ='store_true', help = 'run offline test harness with all implementations')
+    parser.add_argument('-t', '--test', action ='store_true', help = 'run offline test harness with all implementations and a simulated FPGA hasher')
+    parser.add_argument('--benchmark', nargs = '?', const = 'benchmark.json', help = 'benchmark the implementations (the selected one, or all but fpga) and mining stages, writing JSON results to FILE (default benchmark.json)', metavar = "FILE")
+    parser.add_argument('--baseline', help = 'benchmark results to compare --benchmark against, exiting with an error on a regression', metavar = "FILE")
+    parser.add_argument('--regression-threshold', dest = 'regression_threshold', type = float, default = BENCHMARK_THRESHOLD, help = 'fraction a benchmark rate may fall below --baseline (default %s, raise it on a noisy shared machine)' % BENCHMARK_THRESHOLD, metavar = "FRACTION")
 
     parser.add_argument('-v', '--version', action = 'version', version = '%s/%s' % (USER_AGENT, '.'.join(str(v) for v in VERSION)))
 
@@ -714,6 +2291,31 @@ if __name__ == '__main__':
             except Exception as e:
                 message = 'Could not parse username:password for -O/--userpass'
 
+    if options.batch_size < 1:
+        message = 'Batch size for -b/--batch-size must be at least 1'
+    elif options.prefetch < 0:
+        message = 'Number of work units for --prefetch must not be negative'
+    elif options.baseline and not options.benchmark:
+        message = 'May only use --baseline with --benchmark'
+    elif not 0 <= options.ntime_roll <= MAX_NTIME_ROLL:
+        message = 'Seconds for --ntime-roll must be between 0 and %d' % MAX_NTIME_ROLL
+    elif options.solo and not options.coinbase_address:
+        message = 'Must use --coinbase-address with --solo'
+    elif options.coinbase_address and not options.solo:
+        message = 'May only use --coinbase-address with --solo'
+    elif len(options.coinbase_tag.encode()) > 64:
+        message = 'Text for --coinbase-tag must be at most 64 bytes'
+    elif options.metrics_interval <= 0:
+        message = 'Interval for --metrics-interval must be positive'
+    elif options.workers < 1:
+        message = 'Number of workers for -w/--workers must be at least 1'
+    elif options.workers > 1 and options.impl == SHA256D_LIBRARY_FPGA:
+        message = 'May not use -w/--workers with the fpga implementation, use --cpu-workers to mine on the CPU too'
+    elif options.cpu_workers < 0:
+        message = 'Number of workers for --cpu-workers must not be negative'
+    elif options.cpu_workers > 0 and options.impl != SHA256D_LIBRARY_FPGA:
+        message = 'May only use --cpu-workers with the fpga implementation, use -w/--workers instead'
+
     # Was there an issue? Show the help screen and exit.
     if message:
         parser.print_help()
@@ -726,6 +2328,14 @@ if __name__ == '__main__':
     if options.protocol: DEBUG_PROTOCOL = True
     if options.quiet: QUIET = True
     if options.test: TEST = True
+    NUMPY_BATCH_SIZE = options.batch_size
+    FPGA_DEVICE_DRIVER = options.fpga_device
+    FPGA_FORCE_RELOAD = options.fpga_reload
+    if options.fpga_base_addrs: FPGA_BASE_ADDRS = options.fpga_base_addrs
+    FPGA_WAIT_STRATEGY = options.fpga_wait
+    FPGA_PREFETCH = options.prefetch
+    METRICS_INTERVAL = options.metrics_interval
+    METRICS_PORT = options.metrics_port
 
     # Set the library implementation
     if options.impl:
@@ -735,22 +2345,53 @@ if __name__ == '__main__':
             print('Implementation not available for sha256d')
             sys.exit(1)
         else:
-            set_sha256d_library(options.impl)
+            try:
+                set_sha256d_library(options.impl)
+            except ImportError as e:
+                print('Implementation %r for sha256d could not be loaded: %s' % (options.impl, e))
+                sys.exit(1)
     else:
         set_sha256d_library(SHA256D_LIBRARY_AUTO)
-    log('Using sha256d library %r' % SHA256D_LIBRARY, LEVEL_DEBUG)
+    log('Using sha256d library %r (initialized in %.1fms, started in %.1fms)' % (SHA256D_LIBRARY, 1000 * sha256d_init_time(), 1000 * (time.time() - START_TIME)), LEVEL_INFO)
 
     if TEST:
         for library in SHA256D_LIBRARIES:
-            set_sha256d_library(library)
+            try:
+                set_sha256d_library(library)
+            except (ImportError, OSError) as e:
+                log('TEST: Skipping implementation %r (%s)' % (library, e), LEVEL_ERROR)
+                continue
             test_subscription(library)
+        for bulk in (True, False):
+            test_device(bulk)
+    elif options.benchmark:
+        if options.impl and options.impl != SHA256D_LIBRARY_AUTO:
+            libraries = [ options.impl ]
+        else:
+            libraries = [ SHA256D_LIBRARY_HASHLIB, SHA256D_LIBRARY_MIDSTATE, SHA256D_LIBRARY_PYTHON, SHA256D_LIBRARY_NUMPY ]
+        results = benchmark(libraries)
+        startups = benchmark_startups(libraries)
+
+        with open(options.benchmark, 'w') as f:
+            json.dump(dict(version = '.'.join(str(v) for v in VERSION), python = platform.python_version(), machine = platform.machine(), results = results, startup = startups), f, indent = 2, sort_keys = True)
+        log('Benchmark results written to %s' % options.benchmark, LEVEL_INFO)
+
+        if options.baseline:
+            with open(options.baseline) as f:
+                baseline = json.load(f)['results']
+            regressions = compare_benchmark(results, baseline, options.regression_threshold)
+            if regressions:
+                log('Benchmark regressions: %s' % ', '.join(regressions), LEVEL_ERROR)
+                sys.exit(1)
     else:
         # They want a daemon, give them a daemon
         if options.background:
-            import os
             if os.fork() or os.fork(): sys.exit()
     
         # Heigh-ho, heigh-ho, it's off to work we go...
-        if options.url:
-            miner = Miner(options.url, username, password)
+        if options.url and options.solo:
+            miner = SoloMiner(options.url, username, password, options.coinbase_address, workers = options.workers, cpu_workers = options.cpu_workers, cpu_library = options.cpu_impl, version_rolling = options.version_rolling, ntime_roll = options.ntime_roll, coinbase_tag = options.coinbase_tag)
+            miner.serve_forever()
+        elif options.url:
+            miner = MINERS[options.transport](options.url, username, password, workers = options.workers, cpu_workers = options.cpu_workers, cpu_library = options.cpu_impl, version_rolling = options.version_rolling, ntime_roll = options.ntime_roll)
             miner.serve_forever()
@@ -0,0 +1,334 @@
+#########################################################################
+# Richie Harris
+# rkharris12@gmail.com
+# 5/23/2021
+#########################################################################
+
+# register interface of the sha256d hasher in the FPGA overlay
+
+import concurrent.futures, mmap, os, struct, threading, time, sha256d_fpga_sim
+
+# Address of the hasher's register banks in the Pynq-Z2 overlay
+BASE_ADDR = 0x43c00000
+
+# Register bank offsets from the base address
+CTL_STATUS_BASE_ADDR = 0x000
+MID_STATE_BASE_ADDR = 0x400
+RESIDUAL_DATA_BASE_ADDR = 0x800
+TARGET_BASE_ADDR = 0xc00
+REGISTER_SPAN = 0x1000
+
+# Control and status registers
+CTL_RESET = 0x0
+CTL_START = 0x4
+STATUS = 0x8 # clears on read
+GOLDEN_NONCE = 0xc
+CTL_LATCH_NONCE = 0x10
+CURRENT_NONCE = 0x14
+
+# Values of the status register
+STATUS_BUSY = 0
+STATUS_FOUND = 1
+STATUS_NOT_FOUND = 2
+
+# Strategies for waiting on a work unit to finish
+WAIT_BUSY = 'busy'         # poll the status register back to back
+WAIT_ADAPTIVE = 'adaptive' # sleep between polls, backing off towards the expected end of the scan
+WAIT_ASYNC = 'async'       # a watcher thread polls adaptively and resolves a future
+WAIT_STRATEGIES = [ WAIT_BUSY, WAIT_ADAPTIVE, WAIT_ASYNC ]
+
+# Adaptive polling: the interval doubles from the minimum up to a fraction of the
+# expected time to scan all 2^32 nonces, which bounds the hasher's idle time per range
+ADAPTIVE_MIN_INTERVAL = 0.0001
+ADAPTIVE_MAX_INTERVAL = 0.05
+ADAPTIVE_IDLE_FRACTION = 0.001
+
+# Hashrate assumed until a full nonce range has been timed (README: 40 Mhashes/sec)
+DEFAULT_HASHRATE = 40000000
+
+def thread_cpu_time():
+    '''CPU seconds used by the calling thread.'''
+    return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+def int_to_bytes(value, words):
+    '''Converts a register bank value to little endian words, word 0 at the lowest address.'''
+    return value.to_bytes(4 * words, 'little')
+
+class HasherDevice(object):
+    '''One sha256d hasher in the FPGA fabric.
+
+    Subclasses provide the register access (_read, _write and _write_bank). The
+    hasher is used by programming a work unit, starting it and waiting until it
+    finds a golden nonce or runs out of nonces:
+
+    device.program(mid_state, residual_data, target)
+    device.start()
+    status = device.wait(WAIT_ADAPTIVE)
+
+    mid_state, residual_data and target are integers with word 0 in the least
+    significant position, see sha256d_fpga_sim.hash().
+    '''
+
+    def __init__(self, base_addr = BASE_ADDR, bulk = True):
+        self._base_addr = base_addr
+        self._bulk = bulk
+        # Register programming metrics (total time, number of work units)
+        self._program_time = 0.0
+        self._program_count = 0
+        # Measured hashrate, used to predict when a nonce range will be exhausted
+        self._hashrate = DEFAULT_HASHRATE
+        self._start_time = 0.0
+        # Idle time between a work unit finishing and the next one starting
+        self._done_time = None
+        self._idle_time = 0.0
+        self._idle_count = 0
+        # Wait metrics (strategy, wall time, polling CPU time, detection latency, completions)
+        self._wait_strategy = None
+        self._wait_time = 0.0
+        self._wait_cpu_time = 0.0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._completions = 0
+        # Hashes done by finished work units, and whether a work unit is hashing
+        self._lock = threading.Lock()
+        self._hash_total = 0
+        self._running = False
+
+    base_addr = property(lambda s: s._base_addr)
+    program_time = property(lambda s: s._program_time)
+    program_count = property(lambda s: s._program_count)
+    hashrate = property(lambda s: s._hashrate)
+
+    def _read(self, offset):
+        raise Exception('Do not use the HasherDevice class directly, subclass it and override _read')
+
+    def _write(self, offset, value):
+        raise Exception('Do not use the HasherDevice class directly, subclass it and override _write')
+
+    def _write_bank(self, offset, data):
+        '''Writes bytes to consecutive registers, one 32 bit write at a time unless overridden.'''
+        for (index, (value, )) in enumerate(struct.iter_unpack('<I', data)):
+            self._write(offset + 4 * index, value)
+
+    def program(self, mid_state, residual_data, target):
+        '''Writes the mid_state, residual_data and target register banks.'''
+        t0 = time.time()
+        banks = ((MID_STATE_BASE_ADDR, int_to_bytes(mid_state, 8)), (RESIDUAL_DATA_BASE_ADDR, int_to_bytes(residual_data, 3)), (TARGET_BASE_ADDR, int_to_bytes(target, 8)))
+        for (offset, data) in banks:
+            if self._bulk:
+                self._write_bank(offset, data)
+            else:
+                HasherDevice._write_bank(self, offset, data)
+        self._program_time += time.time() - t0
+        self._program_count += 1
+
+    def start(self):
+        '''Starts hashing the programmed work from nonce 0.'''
+        self._write(CTL_START, 0x1)
+        self._running = True
+        self._start_time = time.time()
+        if self._done_time is not None:
+            self._idle_time += self._start_time - self._done_time
+            self._idle_count += 1
+            self._done_time = None
+
+    def poll(self):
+        '''Returns STATUS_BUSY, STATUS_FOUND or STATUS_NOT_FOUND; the hardware clears the status on read.'''
+        return self._read(STATUS)
+
+    def wait(self, strategy = WAIT_BUSY, should_stop = lambda: False, wakeup = None):
+        '''Waits for the started work unit and returns STATUS_FOUND or STATUS_NOT_FOUND.
+
+        Returns None as soon as should_stop() is true. See WAIT_STRATEGIES. wakeup is
+        an optional threading.Event set along with should_stop(), which cuts short
+        the sleeps between adaptive polls.
+        '''
+        if strategy == WAIT_ASYNC:
+            return self.completion(should_stop, wakeup).result()
+        return self._poll_until(strategy == WAIT_ADAPTIVE, should_stop, strategy, wakeup)
+
+    def completion(self, should_stop = lambda: False, wakeup = None):
+        '''Returns a concurrent.futures.Future for the started work unit.
+
+        A watcher thread polls adaptively and resolves the future with the status, or
+        None if should_stop() became true. asyncio code can await it with
+        asyncio.wrap_future().
+        '''
+        future = concurrent.futures.Future()
+        def watch():
+            try:
+                future.set_result(self._poll_until(True, should_stop, WAIT_ASYNC, wakeup))
+            except Exception as e:
+                future.set_exception(e)
+        thread = threading.Thread(target = watch)
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _poll_until(self, adaptive, should_stop, strategy, wakeup = None):
+        t0 = time.time()
+        cpu0 = thread_cpu_time()
+        expected_end = self._start_time + 2**32 / self._hashrate
+        max_interval = min(max(ADAPTIVE_IDLE_FRACTION * 2**32 / self._hashrate, ADAPTIVE_MIN_INTERVAL), ADAPTIVE_MAX_INTERVAL)
+        interval = ADAPTIVE_MIN_INTERVAL
+        last_busy = t0
+        status = None
+        while not should_stop():
+            status = self.poll()
+            now = time.time()
+            if status != STATUS_BUSY:
+                break
+            last_busy = now
+            if adaptive:
+                # don't sleep past the predicted end of the nonce range
+                delay = max(min(interval, expected_end - now), ADAPTIVE_MIN_INTERVAL)
+                if wakeup:
+                    wakeup.wait(delay)
+                else:
+                    time.sleep(delay)
+                interval = min(2 * interval, max_interval)
+        else:
+            status = None
+
+        # The hasher finished somewhere between the last busy poll and this one
+        now = time.time()
+        self._wait_strategy = strategy
+        self._wait_time += now - t0
+        self._wait_cpu_time += thread_cpu_time() - cpu0
+        if status is not None:
+            with self._lock:
+                self._running = False
+                # the hasher stops on the golden nonce, or after the whole range
+                self._hash_total += self._read(GOLDEN_NONCE) if status == STATUS_FOUND else 2**32
+            self._latency_total += now - last_busy
+            self._latency_max = max(self._latency_max, now - last_busy)
+            self._completions += 1
+            self._done_time = now
+            if status == STATUS_NOT_FOUND and now > self._start_time:
+                self._hashrate = 2**32 / (now - self._start_time)
+        return status
+
+    def wait_report(self):
+        '''Summarizes the CPU use and detection latency of the waits and the mean idle time between work units.'''
+        cpu_percent = 100.0 * self._wait_cpu_time / self._wait_time if self._wait_time else 0.0
+        latency_mean = self._latency_total / self._completions if self._completions else 0.0
+        idle_mean = self._idle_time / self._idle_count if self._idle_count else 0.0
+        return 'wait=%s cpu=%.1f%% latency<= mean=%.3fms max=%.3fms completions=%d idle between ranges=%.3fms' % (self._wait_strategy, cpu_percent, 1000 * latency_mean, 1000 * self._latency_max, self._completions, 1000 * idle_mean)
+
+    def golden_nonce(self):
+        '''The nonce that met the target after poll() returned STATUS_FOUND.'''
+        return self._read(GOLDEN_NONCE)
+
+    def hash_count(self):
+        '''Latches and returns the hasher's current nonce, the number of hashes done on this work unit.'''
+        self._write(CTL_LATCH_NONCE, 0x1)
+        return self._read(CURRENT_NONCE)
+
+    def hashes(self):
+        '''Total hashes done by this hasher, including the live count of the work unit hashing now.'''
+        with self._lock:
+            return self._hash_total + (self.hash_count() if self._running else 0)
+
+    def stop(self):
+        '''Resets the hasher and returns the number of hashes done on the abandoned work unit.'''
+        with self._lock:
+            num_hashes = self.hash_count()
+            self._write(CTL_RESET, 0x1)
+            if self._running: self._hash_total += num_hashes
+            self._running = False
+        return num_hashes
+
+class PynqHasherDevice(HasherDevice):
+    '''Hasher registers accessed through pynq.mmio, which must have the overlay loaded.'''
+
+    def __init__(self, base_addr = BASE_ADDR, bulk = True):
+        HasherDevice.__init__(self, base_addr, bulk)
+        from pynq import mmio
+        self._mem = mmio.MMIO(base_addr, REGISTER_SPAN)
+
+    def _read(self, offset):
+        return self._mem.read(offset)
+
+    def _write(self, offset, value):
+        self._mem.write(offset, value)
+
+    def _write_bank(self, offset, data):
+        self._mem.write(offset, data)
+
+class MmapHasherDevice(HasherDevice):
+    '''Hasher registers accessed by mapping /dev/mem directly, without pynq.'''
+
+    def __init__(self, base_addr = BASE_ADDR, bulk = True, path = '/dev/mem'):
+        HasherDevice.__init__(self, base_addr, bulk)
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self._mmap = mmap.mmap(fd, REGISTER_SPAN, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE, offset = base_addr)
+        finally:
+            os.close(fd)
+        # Word view so single registers are accessed with 32 bit loads and stores
+        self._words = memoryview(self._mmap).cast('I')
+
+    def _read(self, offset):
+        return self._words[offset // 4]
+
+    def _write(self, offset, value):
+        self._words[offset // 4] = value
+
+    def _write_bank(self, offset, data):
+        # one word store per register, a slice assignment is a memcpy that may store bytes or wider words
+        (words, index) = (self._words, offset // 4)
+        for (i, value) in enumerate(memoryview(data).cast('I')):
+            words[index + i] = value
+
+class SimulatedHasherDevice(MmapHasherDevice):
+    '''A hasher simulated in software behind the mmap backend's registers, for testing off the board.
+
+    The registers are anonymous memory programmed like /dev/mem. Starting decodes
+    the mid_state, residual_data and target banks and hashes count nonces from
+    first_nonce with sha256d_fpga_sim (the hardware starts at 0), setting the
+    golden nonce and status registers as the hasher would.
+    '''
+
+    def __init__(self, base_addr = BASE_ADDR, bulk = True, first_nonce = 0, count = 256):
+        HasherDevice.__init__(self, base_addr, bulk)
+        self._mmap = mmap.mmap(-1, REGISTER_SPAN)
+        self._words = memoryview(self._mmap).cast('I')
+        self._first_nonce = first_nonce
+        self._count = count
+
+    def _read(self, offset):
+        value = MmapHasherDevice._read(self, offset)
+        if offset == STATUS:
+            self._words[STATUS // 4] = STATUS_BUSY
+        return value
+
+    def _write(self, offset, value):
+        MmapHasherDevice._write(self, offset, value)
+        if offset == CTL_START and value:
+            self._hash()
+
+    def _hash(self):
+        words = self._words
+        mid_state = words[MID_STATE_BASE_ADDR // 4: MID_STATE_BASE_ADDR // 4 + 8].tolist()
+        residual_data = words[RESIDUAL_DATA_BASE_ADDR // 4: RESIDUAL_DATA_BASE_ADDR // 4 + 3].tolist()
+        target = int.from_bytes(self._mmap[TARGET_BASE_ADDR: TARGET_BASE_ADDR + 32], 'little')
+
+        status = STATUS_NOT_FOUND
+        for nonce in range(self._first_nonce, self._first_nonce + self._count):
+            # the second block: residual_data, the nonce (its header bytes are little endian), padding and the 640 bit length
+            block = residual_data + [ int.from_bytes(nonce.to_bytes(4, 'little'), 'big'), 0x80000000 ] + [ 0 ] * 10 + [ 640 ]
+            state = sha256d_fpga_sim.compress(mid_state, block)
+            state = sha256d_fpga_sim.compress(sha256d_fpga_sim.STATE_INIT, state + (0x80000000, 0, 0, 0, 0, 0, 0, 256))
+            if int.from_bytes(struct.pack('>8I', *state), 'little') <= target:
+                (words[GOLDEN_NONCE // 4], status) = (nonce, STATUS_FOUND)
+                break
+        words[CURRENT_NONCE // 4] = nonce
+        words[STATUS // 4] = status
+
+HASHER_DEVICE_PYNQ = 'pynq'
+HASHER_DEVICE_MMAP = 'mmap'
+HASHER_DEVICES = { HASHER_DEVICE_PYNQ: PynqHasherDevice, HASHER_DEVICE_MMAP: MmapHasherDevice }
+
+def open_device(driver = HASHER_DEVICE_PYNQ, base_addr = BASE_ADDR, bulk = True):
+    '''Creates the hasher device for a driver name in HASHER_DEVICES.'''
+    return HASHER_DEVICES[driver](base_addr, bulk)
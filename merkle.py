@@ -0,0 +1,180 @@
+#########################################################################
+# Richie Harris
+# rkharris12@gmail.com
+# 5/23/2021
+#########################################################################
+
+# merkle tree of a block's transactions with cached levels, and the stratum merkle branches of its coinbase
+
+import hashlib, os, sys, time
+
+
+def sha256d(message):
+    '''Double SHA256 Hashing function.'''
+    return hashlib.sha256(hashlib.sha256(message).digest()).digest()
+
+
+def merkle_root_branches_bin(coinbase_hash_bin, branches_bin):
+    '''Folds the stratum merkle branches into the root for a coinbase hash.'''
+    merkle_root_bin = coinbase_hash_bin
+    for branch_bin in branches_bin:
+        merkle_root_bin = sha256d(merkle_root_bin + branch_bin)
+    return merkle_root_bin
+
+
+class MerkleTree(object):
+    '''Merkle tree over txids (32 bytes each, in the byte order they are hashed in).
+
+    Every level is kept: level 0 holds the txids and the last level the root. A
+    level with an odd number of nodes pairs its last node with itself, as bitcoin
+    does. Changing a txid with set_txid() rehashes only its path to the root, and
+    append(), extend() and update() only rehash the nodes right of the first txid
+    that changed, so a block template that gains transactions costs a few hashes
+    per level instead of a rebuild.
+    '''
+
+    def __init__(self, txids_bin = ()):
+        self._levels = [ list(txids_bin) ]
+        self._rehash_from(0)
+
+    def __len__(self):
+        return len(self._levels[0])
+
+    txids = property(lambda s: list(s._levels[0]))
+    depth = property(lambda s: len(s._levels) - 1)
+
+    @property
+    def root(self):
+        '''The merkle root, None for an empty tree.'''
+        top = self._levels[-1]
+        return top[0] if top else None
+
+    def _rehash_from(self, first):
+        '''Recomputes every node above txid first and the txids right of it, adding or dropping levels as the tree grows or shrinks.'''
+        level = 0
+        while len(self._levels[level]) > 1:
+            nodes = self._levels[level]
+            if level + 1 == len(self._levels):
+                self._levels.append([ ])
+            parents = self._levels[level + 1]
+            first //= 2
+            del parents[first:]
+            last = len(nodes) - 1
+            parents.extend([ sha256d(nodes[i] + nodes[i + 1]) for i in range(2 * first, last, 2) ])
+            if last % 2 == 0 and 2 * first <= last:
+                parents.append(sha256d(nodes[last] + nodes[last]))
+            level += 1
+        del self._levels[level + 1:]
+
+    def set_txid(self, index, txid_bin):
+        '''Replaces one txid (index 0 is the coinbase) and rehashes its path to the root.'''
+        self._levels[0][index] = txid_bin
+        for level in range(len(self._levels) - 1):
+            nodes = self._levels[level]
+            index //= 2
+            self._levels[level + 1][index] = sha256d(nodes[2 * index] + nodes[min(2 * index + 1, len(nodes) - 1)])
+
+    def append(self, txid_bin):
+        self.extend([ txid_bin ])
+
+    def extend(self, txids_bin):
+        '''Adds txids at the end of the block.'''
+        first = len(self._levels[0])
+        self._levels[0].extend(txids_bin)
+        self._rehash_from(first)
+
+    def update(self, txids_bin):
+        '''Changes the txids to a new list, rehashing from the first one that differs.
+
+        Returns the index of that txid, len(txids_bin) if nothing changed.
+        '''
+        txids_bin = list(txids_bin)
+        nodes = self._levels[0]
+        first = 0
+        while first < min(len(nodes), len(txids_bin)) and nodes[first] == txids_bin[first]:
+            first += 1
+        if first == len(nodes) == len(txids_bin):
+            return first
+        del nodes[first:]
+        nodes.extend(txids_bin[first:])
+        self._rehash_from(first)
+        return first
+
+    def path(self, index):
+        '''The sibling of each node on the path from a txid to the root, bottom up.'''
+        path = [ ]
+        for nodes in self._levels[:-1]:
+            path.append(nodes[min(index ^ 1, len(nodes) - 1)])
+            index //= 2
+        return path
+
+    def branches(self):
+        '''The merkle branches of mining.notify, hex strings that fold the coinbase hash into the root.
+
+        They never depend on the coinbase, so a placeholder txid at index 0 will do.
+        '''
+        return [ node.hex() for node in self.path(0) ]
+
+
+def merkle_root_rebuild_bin(txids_bin):
+    '''Merkle root built level by level from scratch, the benchmark's reference.'''
+    level = list(txids_bin)
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        level = [ sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2) ]
+    return level[0]
+
+
+def benchmark_rate(count, run, repeat = 3):
+    '''Operations per second of run(), which does count operations, best of repeat runs.'''
+    best = 0.0
+    for i in range(repeat):
+        t0 = time.time()
+        run()
+        best = max(best, count / (time.time() - t0))
+    return best
+
+
+def benchmark(transactions, updates):
+    '''Times building a tree of transactions txids and the updates a block template sees, checking them against rebuilds.'''
+    txids_bin = [ os.urandom(32) for i in range(transactions) ]
+    tree = MerkleTree(txids_bin)
+    if tree.root != merkle_root_rebuild_bin(txids_bin):
+        raise ValueError('merkle root differs from the rebuilt one')
+    if merkle_root_branches_bin(txids_bin[0], [ bytes.fromhex(branch) for branch in tree.branches() ]) != tree.root:
+        raise ValueError('merkle branches do not fold into the root')
+
+    # appends change the tree, so each run starts from a fresh copy built untimed
+    new_txids_bin = [ os.urandom(32) for i in range(updates) ]
+    appends = 0.0
+    for i in range(3):
+        appended = MerkleTree(txids_bin)
+        t0 = time.time()
+        for txid_bin in new_txids_bin:
+            appended.append(txid_bin)
+        appends = max(appends, updates / (time.time() - t0))
+    if appended.root != merkle_root_rebuild_bin(txids_bin + new_txids_bin):
+        raise ValueError('merkle root after appends differs from the rebuilt one')
+
+    results = [
+        ('rebuilt roots/s', benchmark_rate(1, lambda: merkle_root_rebuild_bin(txids_bin))),
+        ('tree builds/s', benchmark_rate(1, lambda: MerkleTree(txids_bin))),
+        ('appends/s', appends),
+        ('coinbase updates/s', benchmark_rate(updates, lambda: [ tree.set_txid(0, txid_bin) for txid_bin in new_txids_bin ])),
+        ('branch lists/s', benchmark_rate(updates, lambda: [ tree.branches() for i in range(updates) ]))
+    ]
+    print('%d transactions, depth %d:' % (transactions, tree.depth))
+    for (name, rate) in results:
+        print('  %-28s %12.1f' % (name, rate))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = "Benchmark the merkle tree against rebuilding the root from scratch")
+    parser.add_argument('-n', '--transactions', type = int, action = 'append', help = 'transactions in the block, repeat for several sizes (default 100, 1000 and 4000)', metavar = "N")
+    parser.add_argument('--updates', type = int, default = 100, help = 'coinbase changes and appended transactions timed per size', metavar = "N")
+    options = parser.parse_args(sys.argv[1:])
+
+    for transactions in options.transactions or [ 100, 1000, 4000 ]:
+        benchmark(transactions, options.updates)
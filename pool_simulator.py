@@ -0,0 +1,334 @@
+#########################################################################
+# Richie Harris
+# rkharris12@gmail.com
+# 5/23/2021
+#########################################################################
+
+# local stratum pool for load and latency testing of fpgaminer.py, every share is checked with hashlib
+
+import argparse, hashlib, json, os, socketserver, sys, threading, time
+
+# Coinbase around the extranonces, the job counter is appended to coinb1 so every job has its own merkle root
+COINB1 = '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff20'
+COINB2 = 'ffffffff01403d522a01000000434104563053b8900762f3d3e8725012d617d177e3c4af3275c3265a1908b434e0df91ec75603d0d8955ef040e5f68d5c36989efe21a59f4ef94a5cc95c99794a84492ac00000000'
+VERSION = '20000000'
+NBITS = '1a6a93b3'
+
+# How far past the current time a share's ntime may be
+MAX_NTIME_AHEAD = 7200
+
+# Version bits miners may roll after mining.configure (BIP 310), the BIP 320 general purpose bits
+VERSION_MASK = '1fffe000'
+
+# Stratum error codes
+ERROR_OTHER = 20
+ERROR_STALE = 21
+ERROR_DUPLICATE = 22
+ERROR_LOW_DIFFICULTY = 23
+
+def log(message):
+    print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message))
+    sys.stdout.flush()
+
+def sha256d(message):
+    '''Double SHA256 Hashing function.'''
+    return hashlib.sha256(hashlib.sha256(message).digest()).digest()
+
+def swap_endian_words(hex_words):
+    '''Swaps the endianness of every 4 byte word of a hex string and converts to bytes.'''
+    message = bytes.fromhex(hex_words)
+    return b''.join([ message[4 * i: 4 * i + 4][::-1] for i in range(0, len(message) // 4) ])
+
+def difficulty_target(difficulty):
+    '''The share target for a stratum difficulty, as fpgaminer.Subscription computes it.'''
+    if difficulty == 0: return 2 ** 256 - 1
+    return min(int((0xffff0000 * 2 ** (256 - 64) + 1) / difficulty - 1 + 0.5), 2 ** 256 - 1)
+
+def percentile(values, fraction):
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+class PoolJob(object):
+    '''One mining.notify: the header fields and the shares already submitted for it.'''
+
+    def __init__(self, job_id, prevhash, merkle_branches, ntime):
+        self.job_id = job_id
+        self.prevhash = prevhash
+        self.coinb1 = COINB1 + '%08x' % int(job_id, 16)
+        self.coinb2 = COINB2
+        self.merkle_branches = merkle_branches
+        self.version = VERSION
+        self.nbits = NBITS
+        self.ntime = ntime
+        self.sent = None
+        self.shares = set()
+
+    def notify_params(self, clean_jobs):
+        return [ self.job_id, self.prevhash, self.coinb1, self.coinb2, self.merkle_branches, self.version, self.nbits, '%08x' % self.ntime, clean_jobs ]
+
+    def header(self, extranonce1, extranonce2, ntime, nonce, version_bits = 0, version_mask = 0):
+        '''The 80 byte block header a share was mined on, built independently of fpgaminer.Job.'''
+        version = '%08x' % ((int(self.version, 16) & ~version_mask) | version_bits)
+        merkle_root = sha256d(bytes.fromhex(self.coinb1 + extranonce1 + extranonce2 + self.coinb2))
+        for branch in self.merkle_branches:
+            merkle_root = sha256d(merkle_root + bytes.fromhex(branch))
+        return swap_endian_words(version) + swap_endian_words(self.prevhash) + merkle_root + swap_endian_words(ntime) + swap_endian_words(self.nbits) + swap_endian_words(nonce)
+
+class StratumPool(object):
+    '''Sends jobs to every connected miner and checks the shares they submit.
+
+    A new job is broadcast every notify_interval seconds and every clean_every-th
+    one starts a new block (new prevhash, clean_jobs true), after which shares for
+    the earlier jobs are stale. Replies to requests are sent reply_delay seconds
+    after the request arrived.
+    '''
+
+    def __init__(self, difficulty = 1, notify_interval = 30, clean_every = 10, reply_delay = 0.0, extranonce2_size = 4, branches = 4, version_mask = int(VERSION_MASK, 16)):
+        self._difficulty = difficulty
+        self._target = difficulty_target(difficulty)
+        self._notify_interval = notify_interval
+        self._clean_every = clean_every
+        self._reply_delay = reply_delay
+        self._extranonce2_size = extranonce2_size
+        self._branches = branches
+        self._version_mask = version_mask
+
+        self._lock = threading.Lock()
+        self._sessions = [ ]
+        self._extranonce1_counter = 0
+        self._job_counter = 0
+        self._prevhash = None
+        # Jobs shares are still accepted for
+        self._jobs = dict()
+        self._job = None
+
+        # Share outcomes and the delays from a job's notify to each share for it
+        self._start_time = time.time()
+        self._counts = dict(accepted = 0, stale = 0, duplicate = 0, invalid = 0)
+        # Accepted shares with rolled version bits
+        self._version_rolled = 0
+        self._latencies = [ ]
+
+        self.new_job()
+
+    difficulty = property(lambda s: s._difficulty)
+    extranonce2_size = property(lambda s: s._extranonce2_size)
+    reply_delay = property(lambda s: s._reply_delay)
+    version_mask = property(lambda s: s._version_mask)
+
+    def add_session(self, session):
+        with self._lock:
+            self._extranonce1_counter += 1
+            self._sessions.append(session)
+            return '%08x' % self._extranonce1_counter
+
+    def remove_session(self, session):
+        with self._lock:
+            if session in self._sessions: self._sessions.remove(session)
+
+    def new_job(self):
+        '''Creates the next job, starting a new block every clean_every jobs, and returns its notify params.'''
+        with self._lock:
+            clean_jobs = self._prevhash is None or (self._clean_every > 0 and self._job_counter % self._clean_every == 0)
+            if clean_jobs:
+                self._prevhash = os.urandom(32).hex()
+                self._jobs = dict()
+            self._job_counter += 1
+            job = PoolJob('%x' % self._job_counter, self._prevhash, [ os.urandom(32).hex() for i in range(self._branches) ], int(time.time()))
+            job.sent = time.time()
+            self._jobs[job.job_id] = job
+            self._job = job
+            self._notify = job.notify_params(clean_jobs)
+            return self._notify
+
+    def current_notify(self):
+        with self._lock:
+            return self._notify
+
+    def broadcast_forever(self):
+        while True:
+            time.sleep(self._notify_interval)
+            params = self.new_job()
+            with self._lock:
+                sessions = list(self._sessions)
+            for session in sessions:
+                session.notify(params)
+            log('Job %s sent to %d miners%s' % (params[0], len(sessions), ' (new block)' if params[-1] else ''))
+
+    def check_share(self, extranonce1, params, version_mask = 0):
+        '''Checks a mining.submit; returns None if the share is accepted or the stratum error.
+
+        version_mask is the mask negotiated with the miner's mining.configure, which
+        allows a sixth parameter with the version bits the share rolled.
+        '''
+        received = time.time()
+        try:
+            (worker_name, job_id, extranonce2, ntime, nonce) = params[:5]
+            if len(bytes.fromhex(extranonce2)) != self._extranonce2_size or len(bytes.fromhex(ntime)) != 4 or len(bytes.fromhex(nonce)) != 4:
+                raise ValueError('field sizes')
+            version_bits = int(params[5], 16) if len(params) > 5 else 0
+        except (TypeError, ValueError) as e:
+            return self._outcome('invalid', [ ERROR_OTHER, 'Malformed share', None ])
+        if version_bits & ~version_mask:
+            return self._outcome('invalid', [ ERROR_OTHER, 'Version bits outside the mask', None ])
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return self._outcome('stale', [ ERROR_STALE, 'Job not found', None ])
+        latency = received - job.sent
+
+        if not job.ntime <= int(ntime, 16) <= received + MAX_NTIME_AHEAD:
+            return self._outcome('invalid', [ ERROR_OTHER, 'ntime out of range', None ], latency)
+
+        share = (extranonce1, extranonce2, ntime, nonce, version_bits)
+        with self._lock:
+            duplicate = share in job.shares
+            job.shares.add(share)
+        if duplicate:
+            return self._outcome('duplicate', [ ERROR_DUPLICATE, 'Duplicate share', None ], latency)
+
+        header = job.header(extranonce1, extranonce2, ntime, nonce, version_bits, version_mask)
+        if int.from_bytes(sha256d(header), 'little') > self._target:
+            return self._outcome('invalid', [ ERROR_LOW_DIFFICULTY, 'Low difficulty share', None ], latency)
+
+        if version_bits:
+            with self._lock:
+                self._version_rolled += 1
+        return self._outcome('accepted', None, latency)
+
+    def _outcome(self, outcome, error, latency = None):
+        with self._lock:
+            self._counts[outcome] += 1
+            if latency is not None: self._latencies.append(latency)
+        return error
+
+    def report(self):
+        '''Share counts, the hashrate they imply and the notify->submit latencies so far.'''
+        with self._lock:
+            counts = dict(self._counts)
+            latencies = sorted(self._latencies)
+            miners = len(self._sessions)
+            version_rolled = self._version_rolled
+        elapsed = time.time() - self._start_time
+        hashrate = counts['accepted'] * self._difficulty * 2 ** 32 / elapsed
+        output = 'miners=%d accepted=%d stale=%d duplicate=%d invalid=%d version rolled=%d (%.2f shares/s, ~%.0f hashes/s)' % (miners, counts['accepted'], counts['stale'], counts['duplicate'], counts['invalid'], version_rolled, counts['accepted'] / elapsed, hashrate)
+        if latencies:
+            output += ' notify->submit mean=%.1fms p50=%.1fms p90=%.1fms max=%.1fms' % (1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.9), 1000 * latencies[-1])
+        return output
+
+class StratumSession(socketserver.StreamRequestHandler):
+    '''One miner's connection; the pool is the server's pool attribute.'''
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self._pool = self.server.pool
+        self._lock = threading.Lock()
+        self._extranonce1 = None
+        self._authorized = False
+        self._version_mask = 0
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode()
+        with self._lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                pass
+
+    def reply(self, message_id, result, error = None):
+        message = dict(id = message_id, result = result, error = error)
+        if self._pool.reply_delay > 0:
+            threading.Timer(self._pool.reply_delay, self.send, (message, )).start()
+        else:
+            self.send(message)
+
+    def notify(self, params):
+        if self._authorized:
+            self.send(dict(id = None, method = 'mining.notify', params = params))
+
+    def handle(self):
+        log('Miner connected from %s:%d' % self.client_address)
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode())
+                    (message_id, method, params) = (request.get('id'), request.get('method'), request.get('params') or [ ])
+                except (ValueError, AttributeError):
+                    log('Bad request %r' % line)
+                    continue
+
+                if method == 'mining.configure':
+                    # only the version-rolling extension is supported, with the pool's mask
+                    result = dict()
+                    (extensions, extension_params) = (params + [ [ ], { } ])[:2]
+                    if 'version-rolling' in extensions:
+                        if self._pool.version_mask:
+                            self._version_mask = int(extension_params.get('version-rolling.mask', 'ffffffff'), 16) & self._pool.version_mask
+                            result['version-rolling'] = True
+                            result['version-rolling.mask'] = '%08x' % self._version_mask
+                        else:
+                            result['version-rolling'] = False
+                    self.reply(message_id, result)
+
+                elif method == 'mining.subscribe':
+                    self._extranonce1 = self._pool.add_session(self)
+                    self.reply(message_id, [ [ [ 'mining.set_difficulty', self._extranonce1 ], [ 'mining.notify', self._extranonce1 ] ], self._extranonce1, self._pool.extranonce2_size ])
+
+                elif method == 'mining.authorize':
+                    self.reply(message_id, True)
+                    self._authorized = True
+                    self.send(dict(id = None, method = 'mining.set_difficulty', params = [ self._pool.difficulty ]))
+                    self.send(dict(id = None, method = 'mining.notify', params = self._pool.current_notify()))
+
+                elif method == 'mining.submit':
+                    if self._extranonce1 is None:
+                        self.reply(message_id, None, [ 25, 'Not subscribed', None ])
+                        continue
+                    error = self._pool.check_share(self._extranonce1, params, self._version_mask)
+                    self.reply(message_id, error is None, error)
+
+                else:
+                    self.reply(message_id, None, [ ERROR_OTHER, 'Unknown method %s' % method, None ])
+        finally:
+            self._pool.remove_session(self)
+            log('Miner %s:%d disconnected' % self.client_address)
+
+class ThreadingStratumServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Local stratum pool for testing fpgaminer.py, connect with -o stratum+tcp://127.0.0.1:PORT")
+    parser.add_argument('--host', default = '127.0.0.1', help = 'address to listen on')
+    parser.add_argument('--port', type = int, default = 3333, help = 'port to listen on')
+    parser.add_argument('--difficulty', type = float, default = 1.0 / 2 ** 16, help = 'share difficulty')
+    parser.add_argument('--notify-interval', dest = 'notify_interval', type = float, default = 30, help = 'seconds between mining.notify messages', metavar = "SECONDS")
+    parser.add_argument('--clean-every', dest = 'clean_every', type = int, default = 10, help = 'every Nth notify starts a new block with clean_jobs (0: only the first)', metavar = "N")
+    parser.add_argument('--reply-delay', dest = 'reply_delay', type = float, default = 0.0, help = 'seconds before replying to a request', metavar = "SECONDS")
+    parser.add_argument('--extranonce2-size', dest = 'extranonce2_size', type = int, default = 4, help = 'bytes of extranonce2', metavar = "BYTES")
+    parser.add_argument('--branches', type = int, default = 4, help = 'merkle branches per job', metavar = "N")
+    parser.add_argument('--version-mask', dest = 'version_mask', default = VERSION_MASK, help = 'version bits miners may roll after mining.configure, hex (0 disables version rolling)', metavar = "HEX")
+    parser.add_argument('--report-interval', dest = 'report_interval', type = float, default = 10, help = 'seconds between reports', metavar = "SECONDS")
+    parser.add_argument('--duration', type = float, default = 0, help = 'stop and report after this many seconds (0 runs until interrupted)', metavar = "SECONDS")
+    options = parser.parse_args(sys.argv[1:])
+
+    pool = StratumPool(options.difficulty, options.notify_interval, options.clean_every, options.reply_delay, options.extranonce2_size, options.branches, int(options.version_mask, 16))
+    server = ThreadingStratumServer((options.host, options.port), StratumSession)
+    server.pool = pool
+
+    for target in (server.serve_forever, pool.broadcast_forever):
+        thread = threading.Thread(target = target)
+        thread.daemon = True
+        thread.start()
+    log('Listening on %s:%d, difficulty %s' % (options.host, options.port, options.difficulty))
+
+    end = time.time() + options.duration if options.duration > 0 else None
+    try:
+        while end is None or time.time() < end:
+            time.sleep(max(min(options.report_interval, end - time.time()), 0) if end else options.report_interval)
+            log(pool.report())
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    log('Final: ' + pool.report())
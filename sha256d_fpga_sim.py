@@ -8,6 +8,7 @@
 
 import hashlib
 import binascii
+import struct
 
 
 # utility functions
@@ -114,6 +115,117 @@ def hash(state, data):
 	
 	return (h << 224) | (g << 192) | (f << 160) | (e << 128) | (d << 96) | (c << 64) | (b << 32) | a
 
+# faster software core: 64 entry message schedule list and rounds on local variables,
+# bit identical to hash() but without shifting a 512 bit integer every round
+STATE_INIT = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+def compress(state, block):
+	"""takes 8 state words (a..h) and 16 message words, returns the 8 word state after the 64 rounds"""
+	return compress_rounds(state, state, list(block), 0)
+
+def compress_rounds(state, working, w, first_round):
+	"""extends the message schedule w to 64 words and runs the rounds from first_round on working (a..h), adding state at the end"""
+	for i in range(len(w), 64):
+		w15 = w[i - 15]
+		w2 = w[i - 2]
+		# the rotates are left unmasked, bits above 32 only carry upwards and are masked off once
+		s0 = ((w15 >> 7) | (w15 << 25)) ^ ((w15 >> 18) | (w15 << 14)) ^ (w15 >> 3)
+		s1 = ((w2 >> 17) | (w2 << 15)) ^ ((w2 >> 19) | (w2 << 13)) ^ (w2 >> 10)
+		w.append((w[i - 16] + (s0 & 0xFFFFFFFF) + w[i - 7] + (s1 & 0xFFFFFFFF)) & 0xFFFFFFFF)
+
+	(a, b, c, d, e, f, g, h) = working
+	for i in range(first_round, 64):
+		e0 = ((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))
+		e1 = ((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))
+		maj = (a & b) ^ (a & c) ^ (b & c)
+		ch = (e & f) ^ ((~e) & g)
+		t1 = h + (e1 & 0xFFFFFFFF) + ch + k[i] + w[i]
+		t2 = (e0 & 0xFFFFFFFF) + maj
+		h = g
+		g = f
+		f = e
+		e = (d + t1) & 0xFFFFFFFF
+		d = c
+		c = b
+		b = a
+		a = (t1 + t2) & 0xFFFFFFFF
+
+	return ((state[0] + a) & 0xFFFFFFFF, (state[1] + b) & 0xFFFFFFFF, (state[2] + c) & 0xFFFFFFFF, (state[3] + d) & 0xFFFFFFFF,
+		(state[4] + e) & 0xFFFFFFFF, (state[5] + f) & 0xFFFFFFFF, (state[6] + g) & 0xFFFFFFFF, (state[7] + h) & 0xFFFFFFFF)
+
+def sigma0(x):
+	return ror(x, 7) ^ ror(x, 18) ^ (x >> 3)
+
+def sigma1(x):
+	return ror(x, 17) ^ ror(x, 19) ^ (x >> 10)
+
+# the second block of an 80 byte header after the nonce (word 3): padding and the 640 bit length
+SECOND_BLOCK_TAIL = (0x80000000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 640)
+
+def precompute(mid_state, residual):
+	"""nonce invariant part of the second block's compression, for scanning word 3 (the nonce)
+
+	takes the 8 mid_state words and the 3 residual words before the nonce. Rounds 0-2
+	only see residual words, round 3 adds the nonce to otherwise fixed terms, and
+	of the message schedule W16 and W17 are fixed while W18 and W19 add a nonce
+	term to a fixed one. returns the tuple compress_nonce() takes
+	"""
+	(w0, w1, w2) = residual
+	(a, b, c, d, e, f, g, h) = mid_state
+	for i in range(3):
+		e0 = ror(a, 2) ^ ror(a, 13) ^ ror(a, 22)
+		e1 = ror(e, 6) ^ ror(e, 11) ^ ror(e, 25)
+		maj = (a & b) ^ (a & c) ^ (b & c)
+		ch = (e & f) ^ ((~e) & g)
+		t1 = (h + e1 + ch + k[i] + residual[i]) & 0xFFFFFFFF
+		t2 = (e0 + maj) & 0xFFFFFFFF
+		(a, b, c, d, e, f, g, h) = ((t1 + t2) & 0xFFFFFFFF, a, b, c, (d + t1) & 0xFFFFFFFF, e, f, g)
+
+	# round 3 without its message word: a and e of round 4 are these plus the nonce
+	e0 = ror(a, 2) ^ ror(a, 13) ^ ror(a, 22)
+	e1 = ror(e, 6) ^ ror(e, 11) ^ ror(e, 25)
+	maj = (a & b) ^ (a & c) ^ (b & c)
+	ch = (e & f) ^ ((~e) & g)
+	t1 = (h + e1 + ch + k[3]) & 0xFFFFFFFF
+	t2 = (e0 + maj) & 0xFFFFFFFF
+	working = ((t1 + t2) & 0xFFFFFFFF, a, b, c, (d + t1) & 0xFFFFFFFF, e, f, g)
+
+	# W16 = s1(W14) + W9 + s0(W1) + W0 with W9 = W14 = 0, W17 = s1(W15) + W10 + s0(W2) + W1 with W10 = 0
+	w16 = (w0 + sigma0(w1)) & 0xFFFFFFFF
+	w17 = (w1 + sigma0(w2) + sigma1(640)) & 0xFFFFFFFF
+	# W18 = s1(W16) + W11 + s0(nonce) + W2, W19 = s1(W17) + W12 + s0(W4) + nonce
+	w18 = (w2 + sigma1(w16)) & 0xFFFFFFFF
+	w19 = (sigma1(w17) + sigma0(0x80000000)) & 0xFFFFFFFF
+	return (tuple(mid_state), working, tuple(residual), (w16, w17, w18, w19))
+
+def compress_nonce(precomputed, nonce):
+	"""second block compression for one nonce word from precompute(), the same 8 words as compress(mid_state, block)"""
+	(mid_state, working, residual, (w16, w17, w18, w19)) = precomputed
+	(a, b, c, d, e, f, g, h) = working
+	w = list(residual)
+	w.append(nonce)
+	w.extend(SECOND_BLOCK_TAIL)
+	w.append(w16)
+	w.append(w17)
+	w.append((w18 + sigma0(nonce)) & 0xFFFFFFFF)
+	w.append((w19 + nonce) & 0xFFFFFFFF)
+	return compress_rounds(mid_state, ((a + nonce) & 0xFFFFFFFF, b, c, d, (e + nonce) & 0xFFFFFFFF, f, g, h), w, 4)
+
+def pad_bin(msg_bin):
+	"""bytes version of pad(), returns the message padded to a 512 bit boundary with its size appended"""
+	return msg_bin + b"\x80" + bytes((55 - len(msg_bin)) % 64) + struct.pack(">Q", len(msg_bin)*8)
+
+def words_to_int(words):
+	"""packs words into an integer with word 0 in the least significant position, the format used by hash()"""
+	value = 0
+	for word in reversed(words):
+		value = (value << 32) | word
+	return value
+
+def int_to_words(value, count):
+	"""unpacks count words from an integer in the format used by hash()"""
+	return [ idx(value, i) for i in range(count) ]
+
 if __name__ == "__main__":
 	# bitcoin block 123,456: test input - 80 bytes, 640 bits, already flipped to network byte order
 	#network_in = "010000009500c43a25c624520b5100adf82cb9f9da72fd2447a496bc600b0000000000006cd862370395dedf1da2841ccda0fc489e3039de5f1ccddef0e834991a65600ea6c8cb4db3936a1ae3143991"
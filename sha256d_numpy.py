@@ -0,0 +1,90 @@
+#########################################################################
+# Richie Harris
+# rkharris12@gmail.com
+# 5/23/2021
+#########################################################################
+
+# batched sha256d over numpy uint32 arrays, one array lane per nonce
+
+import numpy as np
+import sha256d_fpga_sim
+
+K = [ np.uint32(k) for k in sha256d_fpga_sim.k ]
+
+def ror(x, y):
+    return (x >> np.uint32(y)) | (x << np.uint32(32 - y))
+
+def bswap(x):
+    '''Swaps the bytes of every word in a uint32 array.'''
+    return x.byteswap()
+
+def compress(state, w):
+    '''Runs the 64 rounds on arrays; state is 8 words (a..h), w is the 16 word message block.'''
+    return compress_rounds(state, state, list(w), 0)
+
+def compress_rounds(state, working, w, first_round):
+    '''Extends the message schedule w to 64 words and runs the rounds from first_round on working (a..h), adding state at the end.'''
+    for i in range(len(w), 64):
+        s0 = ror(w[i - 15], 7) ^ ror(w[i - 15], 18) ^ (w[i - 15] >> np.uint32(3))
+        s1 = ror(w[i - 2], 17) ^ ror(w[i - 2], 19) ^ (w[i - 2] >> np.uint32(10))
+        w.append(w[i - 16] + s0 + w[i - 7] + s1)
+
+    (a, b, c, d, e, f, g, h) = working
+    for i in range(first_round, 64):
+        e0 = ror(a, 2) ^ ror(a, 13) ^ ror(a, 22)
+        e1 = ror(e, 6) ^ ror(e, 11) ^ ror(e, 25)
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        ch = (e & f) ^ (~e & g)
+        t1 = h + e1 + ch + K[i] + w[i]
+        t2 = e0 + maj
+        (a, b, c, d, e, f, g, h) = (t1 + t2, a, b, c, d + t1, e, f, g)
+
+    return [ x + y for (x, y) in zip(state, (a, b, c, d, e, f, g, h)) ]
+
+def precompute(mid_state, residual_data):
+    '''The nonce invariant rounds and message schedule terms of the second block, see sha256d_fpga_sim.precompute().
+
+    mid_state and residual_data are the integers written to the FPGA registers.
+    '''
+    return sha256d_fpga_sim.precompute(sha256d_fpga_sim.int_to_words(mid_state, 8), sha256d_fpga_sim.int_to_words(residual_data, 3))
+
+def scan(mid_state, residual_data, nonce_start, count, target, nonce_stride = 1, precomputed = None):
+    '''Hashes count nonces (nonce_start, nonce_start + nonce_stride, ...) in one batch.
+
+    mid_state and residual_data are the integers written to the FPGA registers
+    (see sha256d_fpga_sim.hash) and target is the share target as an integer.
+    precomputed is precompute(mid_state, residual_data), which callers scanning
+    several batches of the same work pass to compute it once.
+    Returns a boolean array, True where the nonce's sha256d meets the target.
+    '''
+    nonces = np.arange(count, dtype = np.uint32) * np.uint32(nonce_stride) + np.uint32(nonce_start)
+    lane = lambda word: np.full(count, word, dtype = np.uint32)
+    if precomputed is None:
+        precomputed = precompute(mid_state, residual_data)
+    (state, working, residual, (w16, w17, w18, w19)) = precomputed
+
+    # hash second 512 bit message block from round 4, the header bytes of the nonce are little endian
+    nonce = bswap(nonces)
+    state = [ lane(word) for word in state ]
+    working = [ lane(word) for word in working ]
+    working[0] += nonce
+    working[4] += nonce
+    block = [ lane(word) for word in residual ] + [ nonce ] + [ lane(word) for word in sha256d_fpga_sim.SECOND_BLOCK_TAIL ]
+    block += [ lane(w16), lane(w17), lane(w18) + (ror(nonce, 7) ^ ror(nonce, 18) ^ (nonce >> np.uint32(3))), lane(w19) + nonce ]
+    hash_1 = compress_rounds(state, working, block, 4)
+
+    # hash a second time
+    state = [ lane(word) for word in sha256d_fpga_sim.STATE_INIT ]
+    block = hash_1 + [ lane(0x80000000) ] + [ lane(0) for i in range(6) ] + [ lane(256) ]
+    hash_2 = compress(state, block)
+
+    # the hash is compared as a little endian number, so the last word is the most
+    # significant and only the few nonces whose top word ties the target need more
+    target_top = (target >> 224) & 0xFFFFFFFF
+    top = bswap(hash_2[7])
+    mask = top < np.uint32(target_top)
+    for index in np.flatnonzero(top == np.uint32(target_top)):
+        digest = b''.join(int(word[index]).to_bytes(4, 'big') for word in hash_2)
+        mask[index] = int.from_bytes(digest, 'little') <= target
+
+    return mask